@@ -1,6 +1,6 @@
 import sys
+import os
 import numpy as np
-import pandas as pd
 import threading
 import time
 import zipfile
@@ -17,9 +17,16 @@ from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 
 from connect_arduino import *
-from data_processing.demo_script import post_processing
+from acquisition_process import AcquisitionProcess, MultiDeviceAcquisition
+from data_processing.demo_script import post_processing, analyze_correlation, analyze_peaks, results_tables
+from data_processing.correlator import StreamingCorrelator
+from data_processing.csv_conversion import StreamingPeaks, NUM_SETS
+from data_processing.raw_data import open_raw, record_times, export_csv
+from data_processing.helpers import VISCOSITY_VALUES
+from telemetry import format_telemetry, telemetry_filename
 
 ICONS = 'icons'
+PLOT_BATCHES = 256 # Batches plotted at most, long runs are shown with every n-th batch
 COLORS = {
     'background': '#eff6ff',  # Lighter blue shade
     'text_background': '#36558f',
@@ -183,10 +190,18 @@ class DLSMeasurementApp(QWidget):
         self.meas_interval = 1
         self.pump1_speed = 1.0
         self.pump2_speed = 1.0
+        self.binary_frames = False
+        self.separate_process = False
+        self.all_devices = False
+        self.correlation_analysis = False
 
         # Initialize measurement time
         self.measurement_time = 0
 
+        # Post processing results (results, autocorrelation tables) by device index, written out on download
+        self.results = {}
+        self.streams = [] # StreamingCorrelator or StreamingPeaks of every device
+
         # Data arrays for each sub-tab
         self.particle_time = []
         self.particle_size = []
@@ -198,20 +213,7 @@ class DLSMeasurementApp(QWidget):
         self.dls_values = []
 
         # Default viscosities
-        self.viscosity_values = {
-            "Water": 0.89,  
-            "Ethanol": 1.2,  
-            "Methanol": 0.55,  
-            "Acetone": 0.32,  
-            "Toluene": 0.59,  
-            "Glycerol": 945,  
-            "DMF (Dimethylformamide)": 0.92,  
-            "DMSO (Dimethyl sulfoxide)": 1.99,  
-            "Chloroform": 0.57,  
-            "Hexane": 0.31,  
-            "Benzene": 0.65,  
-            "THF (Tetrahydrofuran)": 0.46,  
-        }
+        self.viscosity_values = dict(VISCOSITY_VALUES)
 
         main_layout = QVBoxLayout()
         self.tab_widget = QTabWidget()
@@ -295,6 +297,15 @@ class DLSMeasurementApp(QWidget):
         progress_line_layout.addWidget(self.progress_bar)
         layout.addLayout(progress_line_layout)
 
+        # State of every device when acquiring from all connected devices
+        self.device_status_label = QLabel("")
+        layout.addWidget(self.device_status_label)
+
+        # Live acquisition telemetry (throughput, losses, latencies)
+        self.telemetry_label = QLabel("")
+        self.telemetry_label.setWordWrap(True)
+        layout.addWidget(self.telemetry_label)
+
         # Sub-tab widget for particle size, temperature and DLS reading graphs
         self.measurement_subtabs = QTabWidget()
         layout.addWidget(self.measurement_subtabs)
@@ -424,6 +435,26 @@ class DLSMeasurementApp(QWidget):
         timing_layout.addWidget(self.interval_label)
         timing_layout.addWidget(self.interval_input)
 
+        self.binary_frames_checkbox = QCheckBox("  Binary Serial Frames")
+        self.binary_frames_checkbox.setChecked(self.binary_frames)
+        self.binary_frames_checkbox.toggled.connect(self.binary_frames_toggled)
+        timing_layout.addWidget(self.binary_frames_checkbox)
+
+        self.separate_process_checkbox = QCheckBox("  Acquire in Separate Process")
+        self.separate_process_checkbox.setChecked(self.separate_process)
+        self.separate_process_checkbox.toggled.connect(self.separate_process_toggled)
+        timing_layout.addWidget(self.separate_process_checkbox)
+
+        self.all_devices_checkbox = QCheckBox("  Acquire from All Connected Devices")
+        self.all_devices_checkbox.setChecked(self.all_devices)
+        self.all_devices_checkbox.toggled.connect(self.all_devices_toggled)
+        timing_layout.addWidget(self.all_devices_checkbox)
+
+        self.correlation_analysis_checkbox = QCheckBox("  Multi-tau Correlation Analysis")
+        self.correlation_analysis_checkbox.setChecked(self.correlation_analysis)
+        self.correlation_analysis_checkbox.toggled.connect(self.correlation_analysis_toggled)
+        timing_layout.addWidget(self.correlation_analysis_checkbox)
+
         timing_group.setLayout(timing_layout)
         main_layout.addWidget(timing_group)
 
@@ -509,13 +540,39 @@ class DLSMeasurementApp(QWidget):
     def download_data(self):
         """Download DLS data"""
         zip_path, _ = QFileDialog.getSaveFileName(self, 'Save ZIP', '', 'ZIP Files (*.zip)')
-        if zip_path:
+        if zip_path and isinstance(self.csv_writer, MultiDeviceAcquisition):
+            with zipfile.ZipFile(zip_path, 'w') as zipf:
+                for index, (label, raw_filename) in enumerate(self.device_raw_files()):
+                    if not os.path.exists(raw_filename):
+                        continue
+                    device = f"device_{index + 1}_"
+                    export_csv(raw_filename, f"{device}data_output.csv")
+                    zipf.write(f"{device}data_output.csv", f"Device{index + 1}_RawData.csv")
+                    if index in self.results:
+                        results_df, corr_df = self.results[index]
+                        zipf.writestr(f"Device{index + 1}_ParticleSize.csv", results_df.to_csv(index=False))
+                        zipf.writestr(f"Device{index + 1}_AutoCorrelation.csv", corr_df.to_csv(index=False))
+                    if os.path.exists(telemetry_filename(raw_filename)):
+                        zipf.write(telemetry_filename(raw_filename), f"Device{index + 1}_Telemetry.json")
+
+            folder_path = zip_path.rsplit('/', 1)[0]
+            QDesktopServices.openUrl(QUrl.fromLocalFile(folder_path))
+
+            print(f'ZIP file created at {zip_path}')
+        elif zip_path:
+            # Raw data is stored in binary, export it to csv for the download
+            export_csv(RAW_FILENAME, 'data_output.csv')
+
             # Create ZIP file
             with zipfile.ZipFile(zip_path, 'w') as zipf:
-                # Add CSVs to the ZIP
-                zipf.write('results.csv', 'ParticleSize.csv')
-                zipf.write('autocorrelation_data.csv', 'AutoCorrelation.csv')
+                # Add CSVs to the ZIP, the results are only written out here
+                if 0 in self.results:
+                    results_df, corr_df = self.results[0]
+                    zipf.writestr('ParticleSize.csv', results_df.to_csv(index=False))
+                    zipf.writestr('AutoCorrelation.csv', corr_df.to_csv(index=False))
                 zipf.write('data_output.csv', 'RawData.csv')
+                if os.path.exists(telemetry_filename(RAW_FILENAME)):
+                    zipf.write(telemetry_filename(RAW_FILENAME), 'Telemetry.json')
 
             # Open the folder where the ZIP was saved (optional)
             folder_path = zip_path.rsplit('/', 1)[0]
@@ -549,6 +606,22 @@ class DLSMeasurementApp(QWidget):
     def meas_interval_input_changed(self):
         self.meas_interval = self.interval_input.value()
 
+    def binary_frames_toggled(self):
+        self.binary_frames = self.binary_frames_checkbox.isChecked()
+
+    def separate_process_toggled(self):
+        self.separate_process = self.separate_process_checkbox.isChecked()
+
+    def all_devices_toggled(self):
+        self.all_devices = self.all_devices_checkbox.isChecked()
+
+    def correlation_analysis_toggled(self):
+        self.correlation_analysis = self.correlation_analysis_checkbox.isChecked()
+
+    def analysis_method(self):
+        # Fit the g2 of the multi-tau correlator, or the peaks cut out of the readings
+        return "correlation" if self.correlation_analysis else "peaks"
+
     def pump1_speed_input_changed(self):
         self.pump1_speed = self.pump_speed_spin1.value()
 
@@ -575,11 +648,31 @@ class DLSMeasurementApp(QWidget):
         self.dls_values.clear()
         self.progress_bar.setValue(0)
 
-        self.csv_writer = GetArdunioData()
+        self.device_status_label.setText("")
+        self.telemetry_label.setText("")
+        self.results = {}
+
+        # A separate process keeps plotting and post processing from stalling the serial reads,
+        # with several devices every device gets its own process
+        if self.all_devices:
+            self.csv_writer = MultiDeviceAcquisition(binary=self.binary_frames)
+        elif self.separate_process:
+            self.csv_writer = AcquisitionProcess(binary=self.binary_frames)
+        else:
+            self.csv_writer = GetArdunioData(binary=self.binary_frames)
         if self.csv_writer.error:
             self.display_error('Arduino is not connected')
         else:
-            self.csv_thread = threading.Thread(target=self.csv_writer.csv_write, args=(self.meas_time,), daemon=True)
+            # g2 or the peaks are extracted as the batches arrive, so they are complete when the acquisition ends
+            stream = StreamingCorrelator if self.correlation_analysis else StreamingPeaks
+            if isinstance(self.csv_writer, MultiDeviceAcquisition):
+                self.streams = [stream() for _ in self.csv_writer.devices]
+                publish = lambda index, *batch: self.streams[index].add_batch(*batch)
+            else:
+                self.streams = [stream()]
+                publish = self.streams[0].add_batch
+            self.csv_thread = threading.Thread(target=self.csv_writer.csv_write, args=(self.meas_time,),
+                kwargs={'publish': publish}, daemon=True)
             self.csv_thread.start()
             time.sleep(2)
             interval_ms = self.meas_interval * 1000
@@ -590,10 +683,32 @@ class DLSMeasurementApp(QWidget):
         self.timer.stop()
         self.csv_writer.stop()
 
+    def device_raw_files(self):
+        """(label, raw store) of every device being measured, the label is empty with a single device"""
+        if isinstance(self.csv_writer, MultiDeviceAcquisition):
+            return [(device.port, raw_filename) for device, raw_filename in zip(self.csv_writer.devices, self.csv_writer.raw_filenames)]
+        return [('', RAW_FILENAME)]
+
+    def update_telemetry(self):
+        """Show the latest telemetry of every device"""
+        if isinstance(self.csv_writer, MultiDeviceAcquisition):
+            self.telemetry_label.setText("\n".join(
+                f"{device.port}: {format_telemetry(snapshot)}"
+                for device, snapshot in zip(self.csv_writer.devices, self.csv_writer.telemetry()) if snapshot))
+        else:
+            self.telemetry_label.setText(format_telemetry(self.csv_writer.telemetry()))
+
     def update_graph(self):
         """
         Update the sub-tab graphs with simulated data and handle progress/time.
         """
+        if isinstance(self.csv_writer, MultiDeviceAcquisition):
+            # A failed device doesn't stop the others, show the state of each
+            self.device_status_label.setText("    ".join(
+                f"{device.port}: {device.error if device.error else 'OK'}" for device in self.csv_writer.devices))
+
+        self.update_telemetry()
+
         if self.csv_writer.error:
             self.display_error(str(self.csv_writer.error))
             self.timer.stop()
@@ -621,7 +736,6 @@ class DLSMeasurementApp(QWidget):
         self.particle_size.append(np.random.uniform(10, 500)) 
 
         try:
-            self.df = pd.read_csv("data_output.csv")
             # Update Particle Size Tab (while measurement is active, before post processing)
             # self.particle_ax.clear()
             # self.particle_ax.plot(
@@ -635,30 +749,43 @@ class DLSMeasurementApp(QWidget):
             # self.particle_ax.grid()
             # self.particle_canvas.draw()
 
-            # Update Temperature Tab
             self.temp_ax.clear()
-            self.temp_ax.plot(
-                self.df['Time(microseconds)'], self.df['Temperature(C)'],
-                color='orange',
-                label='Temperature'
-            )
+            self.dls_ax.clear()
+            devices = self.device_raw_files()
+
+            for label, raw_filename in devices:
+                if not os.path.exists(raw_filename):
+                    continue # The device failed to open
+                # Memory-map the raw data, one record per batch, and only read the batches that are plotted
+                records = open_raw(raw_filename)
+                records = records[::max(1, -(-len(records) // PLOT_BATCHES))]
+
+                # Update Temperature Tab
+                self.temp_ax.plot(
+                    records['start'], records['temp'],
+                    color='orange' if len(devices) == 1 else None,
+                    label=f'Temperature {label}'.strip()
+                )
+
+                # Update DLS Reading Tab
+                self.dls_ax.plot(
+                    record_times(records).reshape(-1), records['samples'].reshape(-1),
+                    color='green' if len(devices) == 1 else None,
+                    label=f'DLS Reading {label}'.strip()
+                )
+
             self.temp_ax.set_title('Temperature Over Time')
             self.temp_ax.set_xlabel('Time (s)')
             self.temp_ax.set_ylabel('Temperature (°C)')
             self.temp_ax.grid()
-            self.temp_canvas.draw()
-
-            # Update DLS Reading Tab
-            self.dls_ax.clear()
-            self.dls_ax.plot(
-                self.df['Time(microseconds)'], self.df['DLS Value'],
-                color='green',
-                label='DLS Reading'
-            )
             self.dls_ax.set_title('DLS Reading Over Time')
             self.dls_ax.set_xlabel('Time (s)')
             self.dls_ax.set_ylabel('DLS Reading (a.u.)')
             self.dls_ax.grid()
+            if len(devices) > 1:
+                self.temp_ax.legend()
+                self.dls_ax.legend()
+            self.temp_canvas.draw()
             self.dls_canvas.draw()
         except Exception as e:
             print(e)
@@ -667,17 +794,20 @@ class DLSMeasurementApp(QWidget):
     def run_post_processing(self):
         """
         Runs the long post_processing task. While running, display "Loading..."
-        in the Particle Size tab. Once done, read the "results.csv" file and update
+        in the Particle Size tab. Once done, keep the results for the download and update
         the plot. Finally, re-enable the Particle Size tab.
         """
+        if isinstance(self.csv_writer, MultiDeviceAcquisition):
+            self.run_post_processing_devices()
+            return
         # Display loading message
         self.measurement_subtabs.setTabEnabled(2, True)
         self.loading_label.setText("Loading...")
-        # Call the blocking post_processing function
-        post_processing()
-        # After processing, read results from results.csv and update the plot.
         try:
-            results_df = pd.read_csv("results.csv")
+            # Call the blocking post_processing function on this run
+            results_df, corr_df = self.device_results(0, RAW_FILENAME)
+            self.results = {0: (results_df, corr_df)}
+            # After processing, update the plot.
             self.particle_ax.clear()
             
             # Use "Radius (nm)" as x-axis.
@@ -710,10 +840,55 @@ class DLSMeasurementApp(QWidget):
 
 
         except Exception as e:
-            print("Error reading results.csv:", e)
+            print("Error processing the results:", e)
         # Re-enable the Particle Size tab and clear the loading message.
         self.loading_label.setText("")
 
+    def device_results(self, index, raw_filename):
+        """Results and autocorrelation tables of one device, from what was streamed during the acquisition when there is any"""
+        # The timer can run out before the acquisition has passed on its last batches (pipeline queues, ring)
+        self.csv_thread.join()
+        snapshot = self.streams[index].snapshot(NUM_SETS) if self.streams else None
+        if snapshot is None:
+            return post_processing(raw_filename, method=self.analysis_method())
+        if self.streams[index].rejected:
+            print(f"Rejected {self.streams[index].rejected} of {self.streams[index].nBatches} batches with spikes")
+        if isinstance(self.streams[index], StreamingCorrelator):
+            return results_tables(analyze_correlation(*snapshot))
+        return results_tables(analyze_peaks(*snapshot))
+
+    def run_post_processing_devices(self):
+        """
+        post_processing for every device, with one curve per device, the contributions
+        averaged over its sets, in the Particle Size tab.
+        """
+        self.measurement_subtabs.setTabEnabled(2, True)
+        self.loading_label.setText("Loading...")
+        self.particle_ax.clear()
+
+        for index, (label, raw_filename) in enumerate(self.device_raw_files()):
+            if not os.path.exists(raw_filename):
+                continue
+            try:
+                results_df, corr_df = self.device_results(index, raw_filename)
+                self.results[index] = (results_df, corr_df)
+                contributions = results_df.filter(like="Contribution")
+                diameters = results_df.filter(like="Diameter").iloc[0]
+                self.particle_ax.plot(
+                    results_df["Radius (nm)"], contributions.mean(axis=1),
+                    label=f"{label}, average diameter = {int(np.nanmean(diameters))} nm"
+                )
+            except Exception as e:
+                print(f"Error processing {raw_filename}:", e)
+
+        self.particle_ax.set_title("Particle Size Results")
+        self.particle_ax.set_xlabel("Radius (nm)")
+        self.particle_ax.set_ylabel("Correlation")
+        self.particle_ax.grid()
+        self.particle_ax.legend()
+        self.particle_canvas.draw()
+        self.loading_label.setText("")
+
     def display_error(self, error_message):
         """Error display"""
         msg_box = QMessageBox()
@@ -0,0 +1,338 @@
+"""
+Run the acquisition (GetArdunioData) in its own process, so plotting and post processing in the
+GUI process never compete with the serial reader for the GIL
+
+Batches are published into a SharedBatchRing that other processes read without copying, and
+lid open / errors / the final counters come back over a control pipe.
+"""
+
+import os
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+from connect_arduino import GetArdunioData, RAW_FILENAME, SUBSET_LENGTH, find_ports
+from data_processing.raw_data import raw_record_dtype
+
+RING_SLOTS  = 1024 # Batches kept in the ring, a few minutes of acquisition
+RING_HEADER = 64   # Bytes before the first slot, holds the number of published batches
+TELEMETRY_INTERVAL = 1.0 # Seconds between telemetry snapshots sent to the parent
+
+class SharedBatchRing:
+
+    """
+    Ring of batch records (data_processing.raw_data.raw_record_dtype) in shared memory
+
+    One process publishes, any number of readers keep their own cursor (the number of batches they have seen).
+    Leave name as None to create the ring, pass the creator's ring.name to attach to it.
+    """
+
+    def __init__(self, name=None, slots=RING_SLOTS, subset_length=SUBSET_LENGTH):
+
+        self.dtype = raw_record_dtype(subset_length)
+        self.slots = slots
+        self.owner = name is None
+
+        self.shm     = shared_memory.SharedMemory(name=name, create=self.owner, size=RING_HEADER + slots * self.dtype.itemsize)
+        self.count   = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.records = np.ndarray((slots,), dtype=self.dtype, buffer=self.shm.buf, offset=RING_HEADER)
+
+        if self.owner:
+            self.count[0] = 0
+
+    @property
+    def name(self):
+
+        return self.shm.name
+
+    def publish(self, start, step, temp_c, dls_values):
+
+        """
+        Same signature as RawDataWriter.write_batch, so it can be used as an acquisition sink
+        """
+
+        record = self.records[self.count[0] % self.slots]
+        record['start']   = start
+        record['step']    = step
+        record['temp']    = temp_c
+        record['samples'] = dls_values
+
+        self.count[0] += 1 # Publish only once the slot is complete
+
+        return None
+
+    def read(self, cursor):
+
+        """
+        Batches published since cursor
+
+        Returns a list of record arrays (views into the ring, two when the ring wraps), the new cursor and the
+        number of batches that were overwritten before they could be read. The views stay valid until the
+        writer comes around the ring again, so copy anything that has to be kept.
+        """
+
+        count = int(self.count[0])
+        lost  = max(0, count - cursor - self.slots)
+        first = cursor + lost
+
+        if first == count:
+            return [], count, lost
+
+        start, end = first % self.slots, count % self.slots
+        if start < end:
+            views = [self.records[start:end]]
+        else:
+            views = [self.records[start:], self.records[:end]]
+
+        return views, count, lost
+
+    def close(self):
+
+        del self.count, self.records # Release the views before the buffer
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def run_acquisition(control, stop_event, ring_name, binary, port):
+
+    """
+    Body of the acquisition process: open the device, wait for ('start', duration, raw_filename), acquire
+    """
+
+    ring   = SharedBatchRing(name=ring_name)
+    device = None
+    lock   = threading.Lock() # Errors and telemetry are sent from different threads
+
+    def send(message):
+        with lock:
+            control.send(message)
+
+    try:
+        device = GetArdunioData(binary=binary, port=port, stop_event=stop_event,
+            on_error=lambda error: send(('error', str(error))))
+
+        if device.error:
+            send(('error', str(device.error)))
+            return
+
+        send(('ready', device.ser.port))
+
+        command = control.recv()
+        if command[0] == 'start':
+            _, duration, raw_filename = command
+
+            done     = threading.Event()
+            reporter = threading.Thread(target=report_telemetry, args=(device, send, done), daemon=True)
+            reporter.start()
+            try:
+                device.csv_write(duration, raw_filename, publish=ring.publish)
+            finally:
+                done.set()
+                reporter.join()
+
+    except Exception as e:
+        send(('error', str(e)))
+
+    finally:
+        if device is not None and device.pipeline is not None:
+            send(('telemetry', device.telemetry()))
+        counters = device.pipeline.counters() if device is not None and device.pipeline is not None else {}
+        send(('done', counters))
+        ring.close()
+
+def report_telemetry(device, send, done):
+
+    """
+    Send a telemetry snapshot every TELEMETRY_INTERVAL until done is set
+    """
+
+    while not done.wait(TELEMETRY_INTERVAL):
+        snapshot = device.telemetry()
+        if snapshot:
+            send(('telemetry', snapshot))
+
+class AcquisitionProcess:
+
+    """
+    GetArdunioData in a separate process, with the same interface (error, csv_write, stop) so the GUI can use either
+
+    csv_write blocks like GetArdunioData.csv_write (run it in a thread) and calls publish for every batch
+    as it appears in the ring, with views into shared memory rather than copies
+    """
+
+    def __init__(self, binary=False, port=None, slots=RING_SLOTS, wait=True):
+
+        self.port       = port
+        self.ring       = SharedBatchRing(slots=slots)
+        self.stop_event = mp.Event()
+        self.control, child_control = mp.Pipe()
+
+        self.error    = None
+        self.counters = {}
+        self.lost     = 0 # Batches the ring overwrote before publish could read them
+        self.snapshot = {} # Latest telemetry from the acquisition process
+
+        self.process = mp.Process(target=run_acquisition,
+            args=(child_control, self.stop_event, self.ring.name, binary, port), daemon=True)
+        self.process.start()
+
+        if wait:
+            self.wait_ready()
+
+    def wait_ready(self):
+
+        """
+        Wait until the device is open (or failed to open), called by __init__ unless wait is False
+        """
+
+        event, message = self.control.recv()
+        if event == 'ready':
+            self.port = message
+        else:
+            self.error = Exception(message)
+            self.process.join()
+            self.ring.close()
+
+        return None
+
+    def csv_write(self, duration=10, raw_filename=RAW_FILENAME, publish=None):
+
+        self.control.send(('start', duration, raw_filename))
+
+        cursor = 0
+        done   = False
+
+        while not done:
+
+            if self.control.poll(0.05):
+                event, message = self.control.recv()
+                if event == 'error':
+                    self.error = Exception(message)
+                elif event == 'telemetry':
+                    self.snapshot = message
+                elif event == 'done':
+                    self.counters, done = message, True
+
+            # After 'done' this also picks up the last batches
+            if publish is not None:
+                cursor = self.forward(cursor, publish)
+
+        self.process.join()
+        self.ring.close()
+
+        return None
+
+    def telemetry(self):
+
+        return self.snapshot
+
+    def forward(self, cursor, publish):
+
+        views, cursor, lost = self.ring.read(cursor)
+        self.lost += lost
+
+        for records in views:
+            for record in records:
+                publish(record['start'], record['step'], record['temp'], record['samples'])
+
+        return cursor
+
+    def stop(self):
+
+        self.stop_event.set()
+
+        return None
+
+def device_raw_filename(index, raw_filename=RAW_FILENAME):
+
+    """
+    Raw store of the index-th device: data_output.dls -> data_output_1.dls, data_output_2.dls, ...
+    """
+
+    root, extension = os.path.splitext(raw_filename)
+
+    return f"{root}_{index + 1}{extension}"
+
+class MultiDeviceAcquisition:
+
+    """
+    Acquire from several devices at once, one AcquisitionProcess per port
+
+    Every device has its own process (so parsing and writing scale across cores), ring, raw store and error.
+    A device that fails (lid open, unplugged) stops on its own, the others keep going; error is only set
+    once no device is left, so the GUI can treat this like a single device.
+    """
+
+    def __init__(self, ports=None, binary=False, slots=RING_SLOTS, raw_filename=RAW_FILENAME):
+
+        self.ports = find_ports() if ports is None else list(ports)
+
+        # Start all the processes first, so the devices are opened (DELAY each) in parallel
+        self.devices = [AcquisitionProcess(binary=binary, port=port, slots=slots, wait=False) for port in self.ports]
+        for device in self.devices:
+            device.wait_ready()
+
+        self.raw_filenames = [device_raw_filename(i, raw_filename) for i in range(len(self.devices))]
+
+    @property
+    def errors(self):
+
+        return [device.error for device in self.devices]
+
+    @property
+    def error(self):
+
+        if not self.devices:
+            return Exception('No device connected')
+
+        if all(self.errors):
+            return Exception("; ".join(f"{device.port}: {device.error}" for device in self.devices))
+
+        return None
+
+    @property
+    def counters(self):
+
+        return [device.counters for device in self.devices]
+
+    def telemetry(self):
+
+        """
+        One snapshot per device
+        """
+
+        return [device.telemetry() for device in self.devices]
+
+    def csv_write(self, duration=10, publish=None):
+
+        """
+        Blocks until every device is done, publish (if given) is called as publish(index, start, step, temp_c, dls_values)
+        """
+
+        threads = []
+
+        for index, (device, raw_filename) in enumerate(zip(self.devices, self.raw_filenames)):
+
+            if device.error:
+                continue
+
+            device_publish = None
+            if publish is not None:
+                device_publish = lambda *batch, index=index: publish(index, *batch)
+
+            thread = threading.Thread(target=device.csv_write, args=(duration, raw_filename, device_publish), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return None
+
+    def stop(self):
+
+        for device in self.devices:
+            device.stop()
+
+        return None
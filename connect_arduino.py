@@ -1,99 +1,446 @@
 import serial
 from serial.tools import list_ports
+import os
+import glob
 import time
-import csv
 import threading
+import binascii
+import queue
 import numpy as np
 
+from data_processing.raw_data import RawDataWriter
+from telemetry import AcquisitionTelemetry, save_telemetry
+
 
 # Configure the serial port
 BAUD_RATE = 115200  
 SUBSET_LENGTH = 800
 DELAY = 2
+RAW_FILENAME = "data_output.dls"
+FAKE_PORT_LINK = "/tmp/ttyMicroDLS" # Created by fake_arduino.py
+
+# Binary frame layout (see upload_DLS.ino): sync, sequence number, SUBSET_LENGTH readings,
+# elapsed time in microseconds, temperature in hundredths of a degree and a CRC-16/CCITT
+# computed over everything between the sync word and the CRC
+FRAME_SYNC = b'\xa5\x5a'
+FRAME_DTYPE = np.dtype([
+    ('sync', '<u2'),
+    ('seq', '<u2'),
+    ('samples', '<u2', (SUBSET_LENGTH,)),
+    ('elapsed', '<u4'),
+    ('temp', '<i2'),
+    ('crc', '<u2'),
+])
+FRAME_SIZE = FRAME_DTYPE.itemsize
+LID_OPEN = b'-1\r\n'
+RING_SIZE = 1 << 16 # Serial receive buffer in bytes, about 40 binary frames or 15 text lines
+QUEUE_SIZE = 256 # Frames / batches buffered between pipeline stages, a few seconds of data
+
+
+def crc16(data):
+    # CRC-16/CCITT-FALSE, same as the firmware's crc16()
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def decode_frame(frame):
+    """
+    Decode one binary frame of FRAME_SIZE bytes (starting with FRAME_SYNC)
+
+    Returns (dls_values, elapsed_time_microseconds, temp_c, seq), or None when the CRC does not match
+    """
+    record = np.frombuffer(frame, dtype=FRAME_DTYPE, count=1)[0]
+
+    if crc16(frame[len(FRAME_SYNC):-2]) != record['crc']:
+        return None
+
+    return record['samples'], int(record['elapsed']), record['temp'] / 100, int(record['seq'])
+
+def parse_text_line(line):
+    """
+    Parse one comma separated batch (800 readings, elapsed time, temperature) in a single numpy call
+
+    Returns (dls_values, elapsed_time_microseconds, temp_c), or None if the line is malformed
+    """
+    try:
+        values = np.fromstring(line, dtype=np.float64, sep=',')
+    except ValueError:
+        return None
+
+    if len(values) != SUBSET_LENGTH + 2:  # Ensure correct format (800 readings + 1 elapsed time)
+        return None
+
+    return values[:-2].astype(np.uint16), int(values[-2]), float(values[-1])
+
+class BatchClock:
+    """
+    Start time and time step (in microseconds) of consecutive batches, as the raw store keeps them
+
+    The firmware only reports the elapsed time of each batch, so the start of a batch is the
+    running sum of all previous elapsed times. The time stamps of the readings are rebuilt from
+    (start, step) by raw_data.record_times.
+    """
+
+    def __init__(self, subset_length=SUBSET_LENGTH):
+        self.subset_length = subset_length
+        self.offset        = 0 # Start of the next batch in microseconds
+
+    def next_batch(self, elapsed_time_microseconds):
+        # Returns the start time and the average time step of the batch, both in microseconds
+        start = self.offset
+        self.offset += elapsed_time_microseconds
+        return start, elapsed_time_microseconds / self.subset_length
+
+def find_ports():
+    """
+    Serial ports of all connected devices: Arduinos (usbmodem / COM8) first, then any running
+    fake_arduino.py emulators (FAKE_PORT_LINK, FAKE_PORT_LINK + '2', ...)
+    """
+    ports = [port.device for port in list_ports.comports() if 'usbmodem' in port.device or 'COM8' in port.device]
+    fakes = [link for link in sorted(glob.glob(FAKE_PORT_LINK + '*')) if os.path.exists(link)]
+    return ports + fakes
+
+def find_port():
+    """
+    Serial port of the device: an Arduino (usbmodem / COM8), otherwise the fake_arduino.py emulator if it is running
+    """
+    ports = find_ports()
+    return ports[0] if ports else None
+
+class SerialRingReader:
+    """
+    Drain the serial port in large chunks into one preallocated buffer and split it into
+    lines (text mode) or frames (binary mode) without building a str per line
+
+    Returned lines and frames are memoryviews into the buffer, they are only valid until the next read
+    """
+
+    def __init__(self, ser, size=RING_SIZE):
+        self.ser    = ser
+        self.buffer = bytearray(size)
+        self.view   = memoryview(self.buffer)
+        self.start, self.end = 0, 0 # Unread bytes are buffer[start:end]
+
+        self.lid_open      = False # Set when a lid open message is seen between binary frames
+        self.bad_frames    = 0
+        self.dropped_bytes = 0
+        self.bytes_read    = 0
+
+    def clear(self):
+        self.start, self.end = 0, 0
+
+    def fill(self):
+        """
+        Read everything the OS has buffered (or wait up to the port timeout for one byte)
+        Returns the number of bytes read, 0 on a timeout
+        """
+        waiting = max(self.ser.in_waiting, 1)
+
+        if self.end + waiting > len(self.buffer):
+            # Move the unread bytes to the front of the buffer
+            unread = self.end - self.start
+            self.buffer[:unread] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, unread
+
+            if self.end == len(self.buffer):
+                # Full buffer without a line or frame in it, nothing worth keeping
+                self.dropped_bytes += self.end
+                self.start, self.end = 0, 0
+
+        waiting = min(waiting, len(self.buffer) - self.end)
+        read = self.ser.readinto(self.view[self.end:self.end + waiting])
+        self.end += read
+        self.bytes_read += read
+
+        return read
+
+    def read_line(self):
+        """
+        Return the next line (without the line ending), or None on a timeout
+        """
+        scanned = 0 # Bytes after self.start already searched for a line ending
+        while True:
+            newline = self.buffer.find(b'\n', self.start + scanned, self.end)
+            if newline >= 0:
+                line_end = newline - 1 if newline > self.start and self.buffer[newline - 1] == 13 else newline
+                line = self.view[self.start:line_end]
+                self.start = newline + 1
+                return line
+
+            scanned = self.end - self.start
+            if self.fill() == 0:
+                return None
+
+    def read_frame(self):
+        """
+        Return the next binary frame with a valid CRC, or None on a timeout
+        """
+        while True:
+            sync = self.buffer.find(FRAME_SYNC, self.start, self.end)
+            if sync < 0:
+                # Keep the last bytes, they could be the start of a sync word or of a lid open message
+                self.skip_to(max(self.start, self.end - len(LID_OPEN) + 1))
+
+            else:
+                self.skip_to(sync)
+                if self.end - self.start >= FRAME_SIZE:
+                    frame = self.view[self.start:self.start + FRAME_SIZE]
+                    if crc16(frame[len(FRAME_SYNC):-2]) == int.from_bytes(frame[-2:], 'little'):
+                        self.start += FRAME_SIZE
+                        return frame
+
+                    # Corrupted frame or a sync word inside the data, look for the next one
+                    self.bad_frames += 1
+                    self.start += 1
+                    continue
+
+            if self.fill() == 0:
+                return None
+
+    def skip_to(self, position):
+        # The firmware only sends text between binary frames when the lid is open
+        if self.buffer.find(LID_OPEN, self.start, min(position + len(LID_OPEN) - 1, self.end)) >= 0:
+            self.lid_open = True
+        self.start = position
+
+class AcquisitionPipeline:
+    """
+    Run the acquisition as three concurrent stages connected by bounded queues
+        reader  - drains the serial port and cuts it into lines / frames (runs on the calling thread)
+        decoder - parses them into batches and rebuilds the time stamps
+        sink    - stores the batches, called as sink(start, time_step, temp_c, dls_values)
+
+    When the decoder queue is full the reader drops the frame and counts it rather than blocking,
+    which would only move the loss to the OS buffer where nobody sees it. The decoder blocks on a
+    full sink queue, so a slow disk pushes back until the reader starts dropping.
+    """
+
+    def __init__(self, reader, sink, binary=False, on_lid_open=None, queue_size=QUEUE_SIZE):
+        self.reader      = reader
+        self.sink        = sink
+        self.binary      = binary
+        self.on_lid_open = on_lid_open
+        self.clock       = BatchClock()
+
+        self.frame_queue = queue.Queue(maxsize=queue_size)
+        self.batch_queue = queue.Queue(maxsize=queue_size)
+        self.failed      = threading.Event()
+        self.error       = None
+        self.telemetry   = AcquisitionTelemetry(queue_size)
+
+        self.frames_read      = 0 # Lines / frames handed to the decoder
+        self.frames_dropped   = 0 # Dropped by the reader because the decoder queue was full
+        self.frames_malformed = 0 # Text lines with the wrong number of values
+        self.frames_missed    = 0 # Gaps in the binary sequence numbers (lost on the link or dropped)
+        self.batches_written  = 0
+        self.last_seq         = None
+
+    def counters(self):
+        return {
+            'read': self.frames_read,
+            'dropped': self.frames_dropped,
+            'malformed': self.frames_malformed + self.reader.bad_frames,
+            'missed': self.frames_missed,
+            'written': self.batches_written,
+            'overflow_bytes': self.reader.dropped_bytes,
+        }
+
+    def snapshot(self):
+        # Counters plus rates and histograms (see telemetry.py)
+        return self.telemetry.snapshot(self.counters(), self.reader.bytes_read)
+
+    def run(self, duration, stop_event):
+        stages = [threading.Thread(target=self.stage, args=(self.decode,), daemon=True),
+                  threading.Thread(target=self.stage, args=(self.write,), daemon=True)]
+        for stage in stages:
+            stage.start()
+
+        try:
+            self.read(duration, stop_event)
+        finally:
+            self.hand_over(self.frame_queue, None) # End of the stream
+            for stage in stages:
+                stage.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def stage(self, target):
+        try:
+            target()
+        except Exception as e:
+            self.error = e
+            self.failed.set()
+
+    def hand_over(self, q, item):
+        # Blocking put that gives up if another stage failed
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def take(self, q):
+        # Blocking get that gives up (returns the end of the stream) if another stage failed
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self.failed.is_set():
+                    return None
+
+    def read(self, duration, stop_event):
+        start_time = time.time()
+
+        while (time.time() - start_time < duration) and not stop_event.is_set() and not self.failed.is_set():
+            frame = self.reader.read_frame() if self.binary else self.reader.read_line()
+            now = time.perf_counter()
+            self.telemetry.sample_rates(self.reader.bytes_read, self.frames_read, now)
+
+            if self.reader.lid_open or (frame is not None and frame == LID_OPEN.strip()):
+                if self.on_lid_open is not None:
+                    self.on_lid_open()
+                break
+
+            if frame is None:
+                continue
+
+            try:
+                self.frame_queue.put_nowait(frame.tobytes()) # Copy out, the reader reuses its buffer
+                self.frames_read += 1
+                self.telemetry.frame_read(self.frame_queue.qsize(), now)
+            except queue.Full:
+                self.frames_dropped += 1
+
+    def decode(self):
+        while True:
+            frame = self.take(self.frame_queue)
+            if frame is None:
+                self.hand_over(self.batch_queue, None)
+                return
+
+            parse_start = time.perf_counter()
+            batch = decode_frame(frame) if self.binary else parse_text_line(frame)
+            if batch is None:
+                self.frames_malformed += 1
+                continue
+
+            dls_values, elapsed_time_microseconds, temp_c = batch[:3]
+            self.telemetry.frame_decoded(elapsed_time_microseconds, time.perf_counter() - parse_start)
+            if self.binary:
+                self.check_sequence(batch[3], elapsed_time_microseconds)
+
+            start, time_step_microseconds = self.clock.next_batch(elapsed_time_microseconds)
+            if not self.hand_over(self.batch_queue, (start, time_step_microseconds, temp_c, dls_values)):
+                return
+
+    def check_sequence(self, seq, elapsed_time_microseconds):
+        if self.last_seq is not None:
+            missed = (seq - self.last_seq - 1) & 0xFFFF
+            self.frames_missed += missed
+            # Keep the time axis continuous over the missing batches
+            self.clock.offset += missed * elapsed_time_microseconds
+        self.last_seq = seq
+
+    def write(self):
+        while True:
+            batch = self.take(self.batch_queue)
+            if batch is None:
+                return
+
+            self.sink(*batch)
+            self.batches_written += 1
 
 class GetArdunioData:
-    def __init__(self):
-        self.stop_event = threading.Event()
+    def __init__(self, binary=False, port=None, stop_event=None, on_error=None):
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.binary = binary # Ask the firmware for binary frames instead of comma separated text
+        self.on_error = on_error # Called with the error as soon as one happens (lid open, failed pipeline stage)
 
-        ports = [port.device for port in list_ports.comports()]
-        serial_port = next((port for port in ports if 'usbmodem' in port or 'COM8' in port), None)
+        serial_port = port if port is not None else find_port()
         self.ser = serial.Serial(serial_port, BAUD_RATE, timeout=1)
+        self.reader = SerialRingReader(self.ser)
+        self.pipeline = None
         time.sleep(DELAY)  # Establish connection
 
         self.error = None if self.ser.is_open else serial.PortNotOpenError
 
-    def csv_write(self, duration=10):
-        batch_times = []
-        batch_num = -1
+    def csv_write(self, duration=10, raw_filename=RAW_FILENAME, publish=None):
+        """
+        Acquire for duration seconds into raw_filename
+        publish, if given, is also called with every batch as sink(start, time_step, temp_c, dls_values)
+        """
     
         # Open the serial connection
         print('Connection established')
         print('Turning laser on...')
         try:
             self.ser.write('H'.encode())
+            if self.binary:
+                self.ser.write('B'.encode())
             
             time.sleep(DELAY)
-            self.ser.readline().decode('ISO-8859-1').strip()
-            self.ser.readline().decode('ISO-8859-1').strip()
-            self.ser.readline().decode('ISO-8859-1').strip()
+            if self.binary:
+                # Drop the text lines sent before the firmware switched, read_frame resyncs on FRAME_SYNC
+                self.ser.reset_input_buffer()
+                self.reader.clear()
+            else:
+                self.reader.read_line()
+                self.reader.read_line()
+                self.reader.read_line()
 
-            # Open CSV file for writing
-            csv_filename = "data_output.csv"
+            # Open the raw data file for writing (data_processing.raw_data.export_csv converts it to csv)
+            with RawDataWriter(raw_filename, SUBSET_LENGTH) as writer:
+                if publish is None:
+                    sink = writer.write_batch
+                else:
+                    def sink(*batch):
+                        writer.write_batch(*batch)
+                        publish(*batch)
 
-
-            with open(csv_filename, mode='w', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow(["Time(microseconds)", "DLS Value", "Temperature(C)"]) 
+                self.pipeline = AcquisitionPipeline(self.reader, sink, self.binary, self.lid_open)
 
                 print("Collecting data...")
-                start_time = time.time()
+                self.pipeline.run(duration, self.stop_event)
         
-                while (time.time() - start_time < duration) and not self.stop_event.is_set():
-                    line = self.ser.readline().decode('ISO-8859-1').strip()
-                    values = line.split(",")
-
-                    if len(values) == SUBSET_LENGTH + 2:  # Ensure correct format (800 readings + 1 elapsed time)
-                        dls_values = [int(v) for v in values[:-2]]  # First 800 values are DLS intensity
-                        elapsed_time_microseconds = int(values[-2])  # Second last value is elapsed time in microseconds
-                        temp_c = float(values[-1]) # Last value is temperature in Celcius
-                        
-                        batch_num += 1
-
-                        # Compute average time step in microseconds
-                        time_step_microseconds = elapsed_time_microseconds / SUBSET_LENGTH  
-                        
-                        # Generate time series in microseconds
-                        if batch_num == 0:
-                            time_series = [int(i * time_step_microseconds) for i in range(SUBSET_LENGTH)]
-                        else:
-                            time_series = [int(i * time_step_microseconds + np.sum(batch_times)) for i in range(SUBSET_LENGTH)]
-                        # Write data to CSV
-                        for t, intensity in zip(time_series, dls_values):
-                            writer.writerow([t, intensity, temp_c])  
-                        batch_times.append(elapsed_time_microseconds)
-                    else:
-                        pass
-                        if values[0] == '-1':
-                            self.error = Exception('LID OPEN: Measurement Stopping')
-                            self.stop()
-                            
-                print(f"Data saved to {csv_filename}")
+                print(f"Data saved to {raw_filename}: {self.pipeline.counters()}")
 
         except Exception as e:
-            pass
+            # A pipeline stage failed (e.g. the disk is full) or the port went away
+            print(f"Acquisition failed: {e!r}")
+            self.set_error(e)
 
+        finally:
+            if self.pipeline is not None:
+                save_telemetry(self.pipeline.snapshot(), raw_filename, port=self.ser.port,
+                    binary=self.binary, error=None if self.error is None else str(self.error))
 
         self.close_connection()
 
+    def lid_open(self):
+        self.set_error(Exception('LID OPEN: Measurement Stopping'))
+        self.stop()
+
+    def telemetry(self):
+        # Live telemetry snapshot, empty until the acquisition has started
+        return self.pipeline.snapshot() if self.pipeline is not None else {}
+
+    def set_error(self, error):
+        self.error = error
+        if self.on_error is not None:
+            self.on_error(error)
+
     def close_connection(self):
         if self.ser.is_open:
             # Turn off laser
             print('Turning laser off...')
             self.ser.write('L'.encode())
+            if self.binary:
+                self.ser.write('T'.encode())
 
             # Close the serial connection
             self.ser.close()
 
     def stop(self):
         # Close
-        self.stop_event.set()
\ No newline at end of file
+        self.stop_event.set()
@@ -0,0 +1,325 @@
+"""
+Multi-tau software correlator: intensity autocorrelation g2 from the raw ADC readings
+
+Level 0 correlates the readings at lags 1..channels-1. Every next level averages pairs of
+points of the previous one and correlates lags channels/2..channels-1 of the binned data,
+so the lags are spaced (nearly) logarithmically and every level costs half the one before:
+the total cost is about channels passes over the data and the number of lags grows only
+with log2 of the segment length.
+
+The device sends its readings in batches with a long pause in between, so the readings are
+correlated within segments (the batches) and the lag sums of all segments are added up.
+g2 uses the symmetric normalization <I(t) I(t+tau)> / (<I(t)> <I(t+tau)>).
+
+For offline re-analysis fft_correlate computes the same sums at every linear lag with one
+batched rfft per chunk of segments (Wiener-Khinchin: the autocorrelation is the inverse
+transform of the power spectrum).
+"""
+
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from scipy import fft
+
+from data_processing.framing import frame_run, kept_segments
+from data_processing.helpers import spike_segments
+
+CHANNELS      = 64  # Lags per level, even
+SUBSET_LENGTH = 800 # Readings per batch sent by the firmware
+BLOCK_SIZE    = 16  # Batches per block of lag sums kept by StreamingCorrelator
+
+def multi_tau_lags(segment_length, channels=CHANNELS):
+
+    """
+    Lags in readings of every level, as (level, lags in binned points) pairs
+    """
+
+    levels = []
+    level, length = 0, segment_length
+
+    while True:
+        first = 1 if level == 0 else channels // 2
+        lags  = np.arange(first, min(channels, length))
+        if len(lags) == 0:
+            break
+        levels.append((level, lags))
+        level, length = level + 1, length // 2
+
+    return levels
+
+def lag_sums(segments, channels=CHANNELS):
+
+    """
+    Per segment sums needed for g2 at every multi-tau lag
+
+    segments - (n segments x segment length) readings
+
+    Returns the lags (in readings) and, per segment and lag, the sum of products, the sums of the
+    leading and trailing windows and the number of pairs (the same for every segment)
+    """
+
+    x = np.asarray(segments, dtype=np.float64)
+
+    lags, products, leading, trailing, pairs = [], [], [], [], []
+
+    for level, level_lags in multi_tau_lags(x.shape[1], channels):
+
+        if level > 0:
+            # Average pairs of points, dropping an odd last one
+            n = x.shape[1] // 2 * 2
+            x = (x[:, 0:n:2] + x[:, 1:n:2]) / 2
+
+        n      = x.shape[1]
+        cumsum = np.cumsum(x, axis=1)
+
+        for j in level_lags:
+            lags.append(j * 2 ** level)
+            products.append(np.einsum('ij,ij->i', x[:, :n - j], x[:, j:]))
+            leading.append(cumsum[:, n - j - 1])
+            trailing.append(cumsum[:, -1] - cumsum[:, j - 1])
+            pairs.append(n - j)
+
+    return (np.array(lags), np.column_stack(products), np.column_stack(leading),
+            np.column_stack(trailing), np.array(pairs))
+
+def g2_from_sums(products, leading, trailing, pairs):
+
+    """
+    Normalized g2 from lag sums added over any number of segments (pairs counted over the same segments)
+    """
+
+    return products * pairs / (leading * trailing)
+
+def multi_tau_correlate(segments, dt, channels=CHANNELS, n_curves=1, chunk=2048, keep=None):
+
+    """
+    g2 of the readings, segments of shape (n segments x segment length), dt the time between readings in seconds
+
+    The segments are split into n_curves consecutive groups with one g2 curve each. The lag sums are added
+    up chunk segments at a time, so a memory-mapped run is never converted to float all at once.
+    keep is a boolean per segment (e.g. the segments without spikes), None to correlate them all.
+
+    Returns time (seconds, one per lag) and autocorrelation (n lags x n curves), the layout of dls_experiment.time
+    and dls_experiment.autocorrelationOriginal
+    """
+
+    segments = np.asarray(segments)
+    columns  = []
+
+    for group in np.array_split(kept_segments(len(segments), keep), n_curves):
+
+        sums = 0
+        for first in range(0, len(group), chunk):
+            lags, products, leading, trailing, pairs = lag_sums(segments[group[first:first + chunk]], channels)
+            sums = sums + np.array([products.sum(axis=0), leading.sum(axis=0), trailing.sum(axis=0)])
+
+        columns.append(g2_from_sums(*sums, pairs * len(group)))
+
+    return lags * dt, np.column_stack(columns)
+
+def correlate_run(time, y_data, subset_length=SUBSET_LENGTH, channels=CHANNELS, n_curves=1):
+
+    """
+    g2 of a run as returned by raw_data.load_raw (time in microseconds, one value per reading),
+    correlated within the batches of subset_length readings the firmware sent
+    """
+
+    segments, dt = segment_run(time, y_data, subset_length)
+
+    return multi_tau_correlate(segments, dt, channels, n_curves)
+
+def segment_run(time, y_data, segment_length=SUBSET_LENGTH):
+
+    """
+    All complete segments of a run as returned by raw_data.load_raw, and the average time between readings in seconds
+    """
+
+    segments, framing = frame_run(time, y_data, segment_length)
+
+    return segments, framing.dt
+
+def fft_correlate(segments, dt, max_lag=None, zero_pad=True, n_curves=1, chunk=2048, keep=None):
+
+    """
+    g2 at every lag 1..max_lag (in readings) of segments (n segments x segment length) with batched FFTs
+
+    zero_pad - pad every segment to at least twice its length so the correlation is linear, with the same
+               sums as multi_tau_correlate. Without padding the correlation is circular (every lag has
+               segment length pairs wrapping around the segment), faster but biased at long lags.
+
+    The lag sums are averaged over the segments of each of n_curves consecutive groups, keep is a boolean per
+    segment as in multi_tau_correlate.
+    Returns time (seconds) and autocorrelation (n lags x n curves), like multi_tau_correlate.
+    """
+
+    segments = np.asarray(segments)
+    length   = segments.shape[1]
+    max_lag  = length - 1 if max_lag is None else min(max_lag, length - 1)
+    lags     = np.arange(1, max_lag + 1)
+    nfft     = fft.next_fast_len(2 * length - 1 if zero_pad else length, real=True)
+
+    columns = []
+    for group in np.array_split(kept_segments(len(segments), keep), n_curves):
+
+        products = np.zeros(max_lag)
+        leading  = np.zeros(max_lag)
+        trailing = np.zeros(max_lag)
+
+        for first in range(0, len(group), chunk):
+
+            x        = segments[group[first:first + chunk]].astype(np.float64)
+            spectrum = fft.rfft(x, n=nfft, axis=1, workers=-1)
+            acf      = fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2, n=nfft, axis=1, workers=-1)
+
+            products += acf[:, 1:max_lag + 1].sum(axis=0)
+            if zero_pad:
+                cumsum    = np.cumsum(x, axis=1).sum(axis=0)
+                leading  += cumsum[length - lags - 1]
+                trailing += cumsum[-1] - cumsum[lags - 1]
+            else:
+                total     = x.sum()
+                leading  += total
+                trailing += total
+
+        pairs = (length - lags if zero_pad else length) * len(group)
+        columns.append(g2_from_sums(products, leading, trailing, pairs))
+
+    return lags * dt, np.column_stack(columns)
+
+def fft_correlate_run(time, y_data, segment_length=SUBSET_LENGTH, **kwargs):
+
+    """
+    fft_correlate of a run as returned by raw_data.load_raw, kwargs are passed to fft_correlate
+
+    The default segments are the firmware batches, longer segments would span the pause between two batches.
+    """
+
+    segments, dt = segment_run(time, y_data, segment_length)
+
+    return fft_correlate(segments, dt, **kwargs)
+
+class StreamingCorrelator:
+
+    """
+    Multi-tau g2 updated batch by batch while the acquisition runs, so the correlation is complete
+    as soon as the last batch arrives
+
+    add_batch has the signature of an acquisition sink (start, step, temp_c, dls_values), pass it as
+    publish to GetArdunioData.csv_write / AcquisitionProcess.csv_write. Batches are buffered and correlated
+    block_size at a time (the same lag sums as multi_tau_correlate, O(batch) per batch), and the sums are
+    kept per block so a snapshot can still split the run into several curves. Batches with a spike
+    (helpers.spike_segments, scored within each batch) are counted in rejected and left out of the sums.
+    """
+
+    def __init__(self, subset_length=SUBSET_LENGTH, channels=CHANNELS, block_size=BLOCK_SIZE):
+
+        levels = multi_tau_lags(subset_length, channels)
+
+        self.channels   = channels
+        self.block_size = block_size
+        self.lags       = np.concatenate([lags * 2 ** level for level, lags in levels])
+        self.pending    = np.empty((block_size, subset_length)) # Batches not correlated yet
+        self.nPending   = 0
+        self.nFlushed   = 0
+        self.blocks     = [] # Products, leading and trailing sums (3 x n lags) per block
+        self.counts     = [] # Batches added to every block
+        self.rejected   = 0  # Batches left out for a spike
+        self.pairs      = None
+        self.step_sum   = 0.0
+        self.lock       = threading.Lock() # Batches arrive on the acquisition thread, snapshots are taken from another
+
+    @property
+    def nBatches(self):
+
+        return self.nFlushed + self.nPending
+
+    def add_batch(self, start, step, temp_c, dls_values):
+
+        with self.lock:
+            self.pending[self.nPending] = dls_values
+            self.nPending += 1
+            self.step_sum += step
+
+            if self.nPending == self.block_size:
+                self.flush()
+
+        return None
+
+    def flush(self):
+
+        """
+        Correlate the pending batches and add them to their block(s), call with the lock held
+        """
+
+        if self.nPending == 0:
+            return None
+
+        pending = self.pending[:self.nPending]
+        kept    = np.flatnonzero(~spike_segments(pending))
+        blocks  = (self.nFlushed + kept) // self.block_size
+
+        while len(self.blocks) <= (self.nFlushed + self.nPending - 1) // self.block_size:
+            self.blocks.append(np.zeros((3, len(self.lags))))
+            self.counts.append(0)
+
+        if len(kept):
+            _, products, leading, trailing, self.pairs = lag_sums(pending[kept], self.channels)
+            for block in np.unique(blocks):
+                rows = blocks == block
+                self.blocks[block] += (products[rows].sum(axis=0), leading[rows].sum(axis=0), trailing[rows].sum(axis=0))
+                self.counts[block] += np.count_nonzero(rows)
+
+        self.rejected += self.nPending - len(kept)
+        self.nFlushed, self.nPending = self.nFlushed + self.nPending, 0
+
+        return None
+
+    def snapshot(self, n_curves=1):
+
+        """
+        g2 of the batches received so far, as multi_tau_correlate returns it: time (seconds) and autocorrelation
+        (n lags x n curves). The curves split the run at block boundaries, so there are at most one per block
+        (blocks whose batches all had spikes are skipped).
+        Returns None before the first batch without a spike.
+        """
+
+        with self.lock:
+            self.flush()
+            if self.pairs is None:
+                return None
+            sums     = np.array(self.blocks)
+            counts   = np.array(self.counts)
+            dt       = self.step_sum / self.nFlushed / 1e6
+            pairs    = self.pairs
+
+        used    = np.flatnonzero(counts) # Blocks with at least one batch without a spike
+        columns = []
+        for group in np.array_split(used, min(n_curves, len(used))):
+            products, leading, trailing = sums[group].sum(axis=0)
+            columns.append(g2_from_sums(products, leading, trailing, pairs * counts[group].sum()))
+
+        return self.lags * dt, np.column_stack(columns)
+
+if __name__ == "__main__":
+
+    from data_processing.raw_data import load_raw
+
+    parser = argparse.ArgumentParser(description="Compute g2 of a recorded run")
+    parser.add_argument("file_name", help="raw store (data_output.dls) or csv")
+    parser.add_argument("output", help="csv with the time in microseconds and one g2 column per curve")
+    parser.add_argument("--fft", action="store_true", help="linear lags with batched FFTs instead of multi-tau")
+    parser.add_argument("--curves", type=int, default=1)
+    parser.add_argument("--segment-length", type=int, default=SUBSET_LENGTH)
+    args = parser.parse_args()
+
+    time, y_data, _ = load_raw(args.file_name)
+    if args.fft:
+        lag_time, g2 = fft_correlate_run(time, y_data, args.segment_length, n_curves=args.curves)
+    else:
+        lag_time, g2 = correlate_run(time, y_data, args.segment_length, n_curves=args.curves)
+
+    columns = {"Time(microseconds)": lag_time * 1e6}
+    for i in range(g2.shape[1]):
+        columns[f"data_set_{i}"] = g2[:, i]
+    pd.DataFrame(columns).to_csv(args.output, index=False)
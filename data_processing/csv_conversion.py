@@ -1,11 +1,12 @@
 import pandas as pd
 import matplotlib.pyplot as plt
-import csv
+import threading
 import numpy as np
+from data_processing.framing import load_segments, kept_segments, DEFAULT_SEGMENT_LENGTH as SUBSET_LENGTH, CHUNK_SEGMENTS
+from data_processing.helpers import spike_segments
 
-SET_LENGTH = 1600
-NUM_SETS = 5
-selected_range = [0, SET_LENGTH * NUM_SETS]
+NUM_SETS = 5 # Curves the segments are pooled into for the fit
+BLOCK_SIZE = 16 # Batches segmented at once by StreamingPeaks
 
 def plot_peak(x, y, local_min_left, local_min_right, local_max):
     plt.figure(figsize=(8, 5))
@@ -30,7 +31,7 @@ def find_local_extrema(y_values, start_idx=100, tolerance=4):
     
     Parameters:
         y_values (list or numpy array): The y-values of the data (intensity, amplitude, etc.).
-        start_idx (int): The index from which to start searching for a local maximum.
+        start_idx (int): Unused, the search starts at the global maximum.
 
     Returns:
         tuple: Indices of the left local minimum, local maximum, and right local minimum.
@@ -39,133 +40,274 @@ def find_local_extrema(y_values, start_idx=100, tolerance=4):
 
     if len(y_values) < 3:
         return None  # Need at least three points to find a peak and minima
-    
-    # Ensure start index is within valid range
-    # start_idx = max(1, min(start_idx, len(y_values) - 2))
-    # print(type(y_values)) 
-    if type(y_values) == np.ndarray:   
-        start_idx = y_values.tolist().index(max(y_values))
-    else:
-        start_idx = y_values.index(max(y_values))
-
-    # Find local maximum starting from start_idx
-    # for i in range(start_idx, len(y_values) - 1):
-    #     if y_values[i - 1] < y_values[i] > y_values[i + 1]:
-    #         peak_idx = i
-    #         break
-    # else:
-    #     return None  # No local maximum found
-    peak_idx = start_idx
-    # Find nearest local minimum to the left
-    left_min_idx = None
-    # print(y_values[peak_idx])
-    for i in range(peak_idx - 1, 0, -1):
-        # print(y_values[i - 1], y_values[i], y_values[i + 1])
-        avg_len = 4
-        forward_average = sum(y_values[i : i - avg_len : -1]) / avg_len
-        # print(forward_average)
-        if y_values[i - 1] >= y_values[i] <= y_values[i + 1] and abs(forward_average - y_values[i]) > tolerance/4:
-            left_min_idx = i
-            break
-            
-    # Find nearest local minimum to the right
-    right_min_idx = None
-    for i in range(peak_idx + 1, len(y_values) - 1):
-        avg_len = 3
-        forward_average = sum(y_values[i : i + avg_len : 1]) / avg_len
-        # print(y_values[i - 1], y_values[i], y_values[i + 1], abs(forward_average - y_values[i]))
-        if y_values[i - 1] >= y_values[i] <= y_values[i + 1] and abs(forward_average - y_values[i]) > tolerance:
-            right_min_idx = i
-            break
-
-    # print(forward_average)
-    # print(y_values[right_min_idx])
-    # print(left_min_idx, peak_idx, right_min_idx)
+
+    left_min_idx, peak_idx, right_min_idx = find_local_extrema_batch(np.asarray(y_values)[None, :], tolerance)
+
     # Ensure both minima exist
-    if left_min_idx is None or right_min_idx is None:
+    if left_min_idx[0] < 0 or right_min_idx[0] < 0:
         return None
 
+    return int(left_min_idx[0]), int(peak_idx[0]), int(right_min_idx[0])
+
+def find_local_extrema_batch(subsets, tolerance=4, window=32):
+    """
+    find_local_extrema for every row of a 2D array (n subsets x subset length) at once.
+
+    The peak is the first global maximum of the row. The left minimum is the nearest point before it with
+    y[i-1] >= y[i] <= y[i+1] that differs from the sum of y[i-3..i] / 4 by more than tolerance / 4 (the sum
+    is 0 for i < 4, as the backwards slice is empty there). The right minimum is the nearest such point
+    after the peak that differs from the sum of y[i..i+2] / 3 by more than tolerance.
+
+    The minima are usually close to the peak, so only window points on each side are tested at first,
+    and the window doubles for the rows that have no minimum in it yet.
+
+    Returns:
+        tuple: Arrays with the left minimum, maximum and right minimum index of every row, -1 where a minimum is missing.
+    """
+
+    y = np.asarray(subsets)
+
+    peak_idx = np.argmax(y, axis=1)
+    left_min_idx  = nearest_minimum(y, peak_idx, -1, lambda back_sum, forward_sum, y0: np.abs(back_sum / 4 - y0) > tolerance / 4, window)
+    right_min_idx = nearest_minimum(y, peak_idx, 1, lambda back_sum, forward_sum, y0: np.abs(forward_sum / 3 - y0) > tolerance, window)
+
     return left_min_idx, peak_idx, right_min_idx
 
-def convert_to_peaks(file_name):
-    df = pd.read_csv(file_name)
+def nearest_minimum(y, peak_idx, step, condition, window):
+    """
+    Nearest index from peak_idx in direction step (-1 or 1) that is a local minimum meeting condition, -1 if none.
+    """
 
-    time, y_data = df['Time(microseconds)'][selected_range[0]:selected_range[1]], df['DLS Value'][selected_range[0]:selected_range[1]]
+    n, length = y.shape
+    dtype = np.result_type(y, np.int64) # Sums of uint16 readings could overflow
+    result = np.full(n, -1)
+    rows = np.arange(n)
+    offset = 1
 
-    time_plot = np.array(time[0:SET_LENGTH])
-   
+    while rows.size and offset < length:
+        cols = peak_idx[rows, None] + step * (offset + np.arange(window))
 
-    average_time = time_plot[-1] / SET_LENGTH
+        def at(shift):
+            return y[rows[:, None], np.clip(cols + shift, 0, length - 1)].astype(dtype)
 
-    # If plotting peak is desired, uncomment
-    # y_plot = np.array(y_data[0:SET_LENGTH])
-    # local_min_left, local_max, local_min_right = find_local_extrema(y_plot)
-    # plot_peak(time_plot, y_plot, local_min_left, local_max, local_min_right)
+        y0, before, after = at(0), at(-1), at(1)
+        # Sums in the same order as sum() over the slices, so float input gives identical averages
+        back_sum = np.where(cols >= 4, y0 + before + at(-2) + at(-3), 0)
+        forward_sum = y0 + np.where(cols + 1 < length, after, 0) + np.where(cols + 2 < length, at(2), 0)
 
-    # Create a time array
-    time = time[0:SET_LENGTH]
-    # Create a column format
-    cols = int(selected_range[1] / SET_LENGTH)
+        hit = (cols >= 1) & (cols <= length - 2) & (before >= y0) & (y0 <= after) & condition(back_sum, forward_sum, y0)
+        found = hit.any(axis=1)
+        result[rows[found]] = cols[found, np.argmax(hit[found], axis=1)]
 
-    # All sets contains every data point, subsets is 1600 point chunks
-    all_sets = []
-    sub_set = []
+        rows = rows[~found]
+        offset += window
+        window *= 2
 
+    return result
 
-    # Create subsets from bulk data
-    for value in y_data:
-        sub_set.append(value)
-        if len(sub_set) == SET_LENGTH-1:
-            all_sets.append(sub_set)
-            sub_set = []
+def segment_peaks(all_sets):
+    """
+    Cut the peak (max value to right min) out of every segment, segmenting all segments at once.
+
+    Every peak is padded with its own minimum (tail) to the length of the longest. Segments without
+    both minima are left out.
 
+    Returns:
+        tuple: Peaks as rows (n peaks x longest peak), their lengths and tails, and the number of segments left out.
+    """
+
+    left_min_idx, peak_idx, right_min_idx = find_local_extrema_batch(all_sets) # left min, max, right min
+    found = (left_min_idx >= 0) & (right_min_idx >= 0)
 
-    # Create sub sets for just peaks
     # -- Max iterations used to ensure the data is the same length
-    sub_maxs = []
-    max_iterations = 0 
+    peak_idx, lengths = peak_idx[found], (right_min_idx - peak_idx)[found]
+    max_iterations = int(np.max(lengths)) if len(lengths) else 0
+
+    offsets = np.arange(max_iterations)
+    inside  = offsets < lengths[:, None]
+    peaks   = np.take_along_axis(np.asarray(all_sets)[found], np.minimum(peak_idx[:, None] + offsets, all_sets.shape[1] - 1), axis=1)
+    tails   = peaks.min(axis=1, where=inside, initial=peaks.max(initial=0))
+    peaks   = np.where(inside, peaks, tails[:, None])
+
+    return peaks, lengths, tails, np.count_nonzero(~found)
+
+def pad_peaks(chunks):
+    """
+    Stack the (peaks, tails) of several segment_peaks calls, padding every peak with its tail to the longest
+    """
+
+    width = max(peaks.shape[1] for peaks, _ in chunks)
+
+    return np.concatenate([np.column_stack((peaks, np.repeat(tails[:, None], width - peaks.shape[1], axis=1)))
+        for peaks, tails in chunks])
+
+def pool_peaks(peaks, n_curves=NUM_SETS):
+    """
+    Average the peaks of n_curves consecutive groups into one curve each, the curves as columns (n times x n curves)
+    """
+
+    groups = np.array_split(np.arange(len(peaks)), min(n_curves, len(peaks)))
+
+    return np.column_stack([peaks[group].mean(axis=0) for group in groups])
+
+def peak_matrix(all_sets, average_time, n_curves=NUM_SETS, chunk=CHUNK_SEGMENTS, keep=None):
+    """
+    Peaks of all segments (see segment_peaks) pooled into n_curves curves
+
+    The segments are segmented chunk at a time, only the (short) peaks of all of them are kept.
+    keep is a boolean per segment (e.g. the segments without spikes), None to use them all.
+
+    Returns:
+        tuple: Time axis (microseconds) and the curves as columns (n times x n curves), the layout of subsets.csv.
+    """
+
+    rows    = kept_segments(len(all_sets), keep)
+    chunks  = [segment_peaks(all_sets[rows[first:first + chunk]]) for first in range(0, len(rows), chunk)]
+    peaks   = pad_peaks([(peaks, tails) for peaks, _, tails, _ in chunks])
+    missing = sum(missing for _, _, _, missing in chunks)
+    if len(peaks) == 0:
+        raise ValueError("No peak found in any segment")
+    if missing:
+        print(f"No peak found in {missing} of {len(rows)} segments")
+
+    subset_time_array = np.arange(peaks.shape[1]) * average_time
+
+    return subset_time_array, pool_peaks(peaks, n_curves)
+
+class StreamingPeaks:
+
+    """
+    Peaks cut out of the batches while the acquisition runs, so the peak curves are ready as soon as
+    the last batch arrives
+
+    add_batch has the signature of an acquisition sink (start, step, temp_c, dls_values), pass it as
+    publish to GetArdunioData.csv_write / AcquisitionProcess.csv_write. Batches are buffered and segmented
+    block_size at a time and their peaks are added to a growing matrix, padded like peak_matrix: when a
+    longer peak arrives every row is extended with its own tail. Batches with a spike (helpers.spike_segments,
+    scored within each batch) are counted in rejected and not segmented.
+    """
+
+    def __init__(self, subset_length=SUBSET_LENGTH, block_size=BLOCK_SIZE):
+
+        self.block_size = block_size
+        self.pending    = np.empty((block_size, subset_length), dtype=np.int64) # Batches not segmented yet
+        self.nPending   = 0
+        self.nFlushed   = 0
+        self.missing    = 0 # Batches without a peak
+        self.rejected   = 0 # Batches left out for a spike
+        self.peaks      = np.empty((0, 0), dtype=np.int64) # Rows beyond nPeaks are spare capacity
+        self.tails      = np.empty(0, dtype=np.int64)
+        self.nPeaks     = 0
+        self.step_sum   = 0.0
+        self.lock       = threading.Lock() # Batches arrive on the acquisition thread, snapshots are taken from another
+
+    @property
+    def nBatches(self):
+
+        return self.nFlushed + self.nPending
+
+    def add_batch(self, start, step, temp_c, dls_values):
+
+        with self.lock:
+            self.pending[self.nPending] = dls_values
+            self.nPending += 1
+            self.step_sum += step
+
+            if self.nPending == self.block_size:
+                self.flush()
+
+        return None
+
+    def flush(self):
 
-    for subset in all_sets:
-        data_set = find_local_extrema(subset) # left min, max, right min
-        values = subset[data_set[1]:data_set[2]] # Create peak set from max value to right min
-        if len(values) > max_iterations: max_iterations = len(values) # Find max iterations
-        sub_maxs.append(values)
+        """
+        Segment the pending batches and add their peaks to the matrix, call with the lock held
+        """
 
-    # Sort from longest to highest to create the time space
-    sub_maxs = sorted(sub_maxs, key=len)
-    subset_time_array = np.arange(0, (max_iterations) * average_time, average_time)
+        if self.nPending == 0:
+            return None
+
+        pending        = self.pending[:self.nPending]
+        spikes         = spike_segments(pending)
+        self.nFlushed += self.nPending
+        self.nPending  = 0
+        self.rejected += np.count_nonzero(spikes)
+        if np.all(spikes):
+            return None
+
+        peaks, _, tails, missing = segment_peaks(pending[~spikes])
+        self.missing  += missing
+
+        rows, width = self.nPeaks + len(peaks), max(self.peaks.shape[1], peaks.shape[1])
+
+        # Grow the rows (doubling) and the width (padding every row with its tail)
+        if rows > len(self.peaks) or width > self.peaks.shape[1]:
+            capacity = max(rows, 2 * len(self.peaks)) if rows > len(self.peaks) else len(self.peaks)
+            grown = np.empty((capacity, width), dtype=np.int64)
+            grown[:self.nPeaks, :self.peaks.shape[1]] = self.peaks[:self.nPeaks]
+            grown[:self.nPeaks, self.peaks.shape[1]:] = self.tails[:self.nPeaks, None]
+            self.peaks = grown
+            self.tails = np.resize(self.tails, len(grown))
+
+        self.peaks[self.nPeaks:rows, :peaks.shape[1]] = peaks
+        self.peaks[self.nPeaks:rows, peaks.shape[1]:] = tails[:, None]
+        self.tails[self.nPeaks:rows] = tails
+        self.nPeaks = rows
+
+        return None
+
+    def snapshot(self, n_curves=NUM_SETS):
+
+        """
+        Peak curves of the batches received so far, as peak_matrix returns them: time (microseconds) and
+        the curves (n times x n curves). Returns None before the first peak.
+        """
+
+        with self.lock:
+            self.flush()
+            if self.nPeaks == 0:
+                return None
+            average_time = self.step_sum / self.nFlushed
+            matrix       = pool_peaks(self.peaks[:self.nPeaks], n_curves)
+            width        = self.peaks.shape[1]
+
+        return np.arange(width) * average_time, matrix
+
+def set_names(nSets):
+
+    return ["data_set_" + str(i) for i in range(nSets)]
+
+def convert_to_peaks(file_name, segment_length=None):
+    """
+    Export a run as converted.csv (every reading of every segment, one per row) and subsets.csv (the peak curves),
+    the analysis itself works on peak_matrix directly (see demo_script.analyze)
+    """
+    # Raw store (data_output.dls) or csv, framed at its batch length
+    all_sets, framing = load_segments(file_name, segment_length)
+    average_time = framing.dt * 1e6
+
+    subset_time_array, matrix = peak_matrix(all_sets, average_time)
 
     csv_filename = "converted.csv" # Converted is for entire dataset
     csv_subsetfile = "subsets.csv" # subsets extracts peaks only
-    col_headers = ["Time(microseconds)"]
-
-    # Convert full files
-    for i in range(cols):
-        col_headers.append("data_set_" + str(i))
 
+    # One row per reading (segment, time within the segment, value), written chunk by chunk
+    time = np.arange(framing.segment_length) * average_time
     with open(csv_filename, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(col_headers)  # Updated header
-        for j in range(SET_LENGTH-1):
-            data = [time[j]]
-            for set_val in range(NUM_SETS):
-                data.append(all_sets[set_val][j])
-            writer.writerow(data)
+        file.write("Segment,Time(microseconds),DLS Value\n")
+        for first in range(0, len(all_sets), CHUNK_SEGMENTS):
+            chunk = np.asarray(all_sets[first:first + CHUNK_SEGMENTS])
+            rows = np.column_stack((
+                np.repeat(np.arange(first, first + len(chunk)), chunk.shape[1]),
+                np.tile(time, len(chunk)),
+                chunk.reshape(-1)))
+            np.savetxt(file, rows, fmt=('%d', '%.3f', '%d'), delimiter=',')
 
     print("Full file converted")
 
-    with open(csv_subsetfile, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(col_headers)  # Updated header
-        for index, t in enumerate(subset_time_array):
-            data = [t]
-            for sub in sub_maxs:
-                tail = min(sub)
-                if index < len(sub):
-                    data.append(sub[index])
-                else:
-                    data.append(tail)
-            writer.writerow(data)
+    columns = {"Time(microseconds)": subset_time_array}
+    columns.update(zip(set_names(matrix.shape[1]), matrix.T))
+    pd.DataFrame(columns).to_csv(csv_subsetfile, index=False)
 
     print("Subset file converted")
 
@@ -1,166 +1,195 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import csv
-import numpy as np
-from scipy.signal import argrelextrema, find_peaks
-
-SET_LENGTH = 1600
-NUM_SETS = 4
-EXPECTED_TIME = 14110 # Microseconds per subset_length
-TIME_PER_DATA = EXPECTED_TIME / SET_LENGTH
+"""
+Averaged signal: the mean of the segments of a run and the peak (max value to right min) of that mean
 
-selected_range = [0, SET_LENGTH * NUM_SETS]
+Averaging the segments before looking for the peak cancels most of the noise of the single segments.
+All functions work on (n segments x segment length) arrays as returned by framing.load_segments,
+smoothing and peak finding are done for every row at once.
+"""
 
-df = pd.read_csv("0311raw_4v_laser/95J_great.csv")
-
-time, y_data = df['Time(microseconds)'][selected_range[0]:selected_range[1]], df['DLS Value'][selected_range[0]:selected_range[1]]
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.ndimage import uniform_filter1d
+from scipy.signal import find_peaks, peak_prominences
 
-time_plot = np.array(time[0:SET_LENGTH])
-y_plot = np.array(y_data[0:SET_LENGTH])
+from data_processing.framing import load_segments, kept_segments, CHUNK_SEGMENTS
 
-# time_plot = np.array(time[3200:4800])
-# y_plot = np.array(y_data[3200:4800])
+def average_segments(segments, n_groups=1, keep=None, chunk=CHUNK_SEGMENTS):
+    """
+    Mean of n_groups consecutive groups of segments (n_groups x segment length), left over segments are dropped
 
-average_time = time_plot[-1] / SET_LENGTH
-# print(average_time)
+    keep is a boolean per segment (e.g. the segments without spikes), None to average them all. The segments
+    are added up chunk at a time, so a memory-mapped run is never copied whole.
+    """
 
-# y_plot = y_data[0:SET_LENGTH]
+    segments = np.asarray(segments)
+    rows = kept_segments(len(segments), keep)
+    nSegments = len(rows) // n_groups * n_groups
+    if nSegments == 0:
+        raise ValueError(f"{len(rows)} segments can't be split into {n_groups} groups")
 
-# plt.figure(figsize=(8, 5))
-# plt.plot(time_plot, y_plot, marker='o', linestyle='-', color='b', label="Data")
+    groups = rows[:nSegments].reshape(n_groups, -1)
+    sums = np.zeros((n_groups, segments.shape[1]))
+    for group, group_rows in enumerate(groups):
+        for first in range(0, len(group_rows), chunk):
+            sums[group] += segments[group_rows[first:first + chunk]].sum(axis=0, dtype=np.float64)
 
-# # Labels and title
-# plt.xlabel("X Data")
-# plt.ylabel("Y Data")
-# plt.title("Plot of X vs Y")
-# plt.legend()
-# plt.grid(True)
+    return sums / groups.shape[1]
 
-# # Show plot
-# plt.show()
+def smooth_signal(y_values, window=5):
+    """Applies a simple moving average for noise reduction, along the last axis."""
+    # Zero padded like np.convolve(y_values, np.ones(window)/window, mode='same')
+    return uniform_filter1d(np.asarray(y_values, dtype=np.float64), window, axis=-1, mode='constant')
 
-time = time[0:SET_LENGTH]
+def row_peaks(rows, prominence):
+    """
+    find_peaks of every row of a 2D array in one call
 
-cols = int(selected_range[1] / SET_LENGTH)
+    The rows are joined with a separator above every value in between, so no peak nor prominence
+    reaches across two rows and the result is the same as find_peaks row by row.
 
-num_sets = []
+    Returns:
+        tuple: Row and column of every peak, ordered by row then column.
+    """
 
-sub_set = []
+    n, length = rows.shape
+    joined = np.full((n, length + 1), rows.max() + abs(prominence) + 1 if rows.size else 0.0)
+    joined[:, :length] = rows
 
+    # Prominences only of the peaks inside the rows, a separator's would be searched over the whole array
+    peaks, _ = find_peaks(joined.ravel())
+    peaks = peaks[peaks % (length + 1) < length]
+    peaks = peaks[peak_prominences(joined.ravel(), peaks)[0] >= prominence]
 
-# Create subsets from bulk data
-for value in y_data:
-    sub_set.append(value)
-    if len(sub_set) == SET_LENGTH:
-        num_sets.append(sub_set)
-        sub_set = []
+    return np.divmod(peaks, length + 1)
 
+def extract_extrema_batch(segments, prominence=0.5, smooth_window=5):
+    """
+    Index of the maximum peak and the closest local minima on either side, for every segment at once
 
-plt.figure(figsize=(8, 5))
-for i in range(NUM_SETS):
-    
-    plt.plot(time_plot, num_sets[i], marker='o', linestyle='-', label="Data")
+    The segments are smoothed with a moving average and the extrema are the smoothed local maxima and
+    minima with at least the given prominence. The peak of a segment is its highest local maximum.
 
-    # Labels and title
-plt.xlabel("Time us")
-plt.ylabel("Raw Intensity")
-plt.title("Plot of X vs Y")
-plt.legend()
-plt.grid(True)
-plt.show()
-
-avg_data = []
-
-for i in range(SET_LENGTH):
-    for j in range(NUM_SETS):
-        if j == 0:
-            avg_data.append(num_sets[j][i])
-        else:
-            avg_data[i] += num_sets[j][i]
-    avg_data[i] = avg_data[i] / NUM_SETS
-
-plt.figure(figsize=(8, 5))
-plt.plot(time_plot, avg_data, marker='o', linestyle='-', label="Average Signal")
-plt.xlabel("Time us")
-plt.ylabel("Raw Intensity")
-plt.title("Plot of X vs Y")
-plt.legend()
-plt.grid(True)
-plt.show()
-
-csv_filename = "average_data.csv"
-with open(csv_filename, mode='w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerow(["Time(microseconds)", "Average Signal"])  # Updated header
-    for j in range(SET_LENGTH-1):
-        data = [time[j]]
-        data.append(avg_data[j])
-        writer.writerow(data)
+    :param segments: 2D array (n segments x segment length) of y-values (raw or averaged data)
+    :param prominence: Minimum prominence for peak detection to ignore small bumps.
+    :param smooth_window: Window size for moving average smoothing.
+    :return: Tuple of arrays (left_min_index, max_index, right_min_index), -1 where it wasn't found
+    """
+    smoothed = smooth_signal(np.atleast_2d(segments), window=smooth_window)
+    n = len(smoothed)
+
+    max_row, max_col = row_peaks(smoothed, prominence)
+    min_row, min_col = row_peaks(-smoothed, prominence)
+
+    # Highest (first of equally high) local maximum of every row: the last one of each row once sorted by height
+    max_index = np.full(n, -1)
+    order = np.lexsort((-max_col, smoothed[max_row, max_col], max_row))
+    max_row, max_col = max_row[order], max_col[order]
+    last = np.ones(len(max_row), dtype=bool)
+    last[:-1] = max_row[1:] != max_row[:-1]
+    max_index[max_row[last]] = max_col[last]
+
+    # Closest minima: the neighbours of the peak among the minima, ordered by row then column
+    left_min_index = np.full(n, -1)
+    right_min_index = np.full(n, -1)
+    rows = np.flatnonzero(max_index >= 0)
+    if len(min_row):
+        keys = min_row * smoothed.shape[1] + min_col
+        peak_keys = rows * smoothed.shape[1] + max_index[rows]
+
+        left = np.searchsorted(keys, peak_keys) - 1
+        found = (left >= 0) & (min_row[np.maximum(left, 0)] == rows)
+        left_min_index[rows[found]] = min_col[left[found]]
+
+        right = np.searchsorted(keys, peak_keys, side='right')
+        found = (right < len(keys)) & (min_row[np.minimum(right, len(keys) - 1)] == rows)
+        right_min_index[rows[found]] = min_col[right[found]]
 
-def smooth_signal(y_values, window=5):
-    """Applies a simple moving average for noise reduction."""
-    return np.convolve(y_values, np.ones(window)/window, mode='same')
+    return left_min_index, max_index, right_min_index
 
 def extract_extrema(y_values, prominence=0.5, smooth_window=5):
     """
     Extract the index of the maximum peak and the two local minima on either side,
     with noise reduction and prominence filtering.
-    
+
     :param y_values: List or numpy array of y-values (raw data)
     :param prominence: Minimum prominence for peak detection to ignore small bumps.
     :param smooth_window: Window size for moving average smoothing.
     :return: Tuple (left_min_index, max_index, right_min_index)
     """
-    y_values = np.array(y_values)
-    smoothed_y = smooth_signal(y_values, window=smooth_window)
-    
-    # Find local maxima and minima with prominence filtering
-    maxima_indices, _ = find_peaks(smoothed_y, prominence=prominence)
-    minima_indices, _ = find_peaks(-smoothed_y, prominence=prominence)
-    
-    if len(maxima_indices) == 0 or len(minima_indices) < 2:
+    left_min_index, max_index, right_min_index = extract_extrema_batch(np.asarray(y_values)[None, :], prominence, smooth_window)
+
+    if max_index[0] < 0:
         raise ValueError("Not enough significant extrema found to determine a peak with two surrounding minima.")
-    
-    # Identify the global max index among local maxima
-    max_index = maxima_indices[np.argmax(smoothed_y[maxima_indices])]
-    
-    # Find the closest left and right minima
-    left_minima = minima_indices[minima_indices < max_index]
-    right_minima = minima_indices[minima_indices > max_index]
-    
-    if len(left_minima) == 0 or len(right_minima) == 0:
+
+    if left_min_index[0] < 0 or right_min_index[0] < 0:
         raise ValueError("Could not find both left and right local minima around the peak.")
-    
-    left_min_index = left_minima[-1]  # Last (closest) left minimum
-    right_min_index = right_minima[0]  # First (closest) right minimum
-    
-    return left_min_index, max_index, right_min_index
 
-left_min_idx, peak_idx, right_min_idx = extract_extrema(avg_data)
-
-plt.figure(figsize=(8, 5))
-plt.plot(time_plot, avg_data, marker='o', linestyle='-', color='b', label="Data")
-
-plt.axvline(x=time_plot[left_min_idx], color='y', linestyle='--', linewidth=2, label="Local min (left)")
-plt.axvline(x=time_plot[peak_idx], color='r', linestyle='--', linewidth=2, label="Local min (right)")
-plt.axvline(x=time_plot[right_min_idx], color='g', linestyle='--', linewidth=2, label="Local max")
-# Labels and title
-plt.xlabel("X Data")
-plt.ylabel("Y Data")
-plt.title("Plot of X vs Y")
-plt.legend()
-plt.grid(True)
-
-# Show plot
-plt.show()
-
-# print(left_min_idx, peak_idx, right_min_idx)
-
-csv_filename = "average_data_peak.csv"
-with open(csv_filename, mode='w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerow(["Time(microseconds)", "Average Signal"])  # Updated header
-    for j in range(peak_idx, right_min_idx):
-        data = [time[j] - time[peak_idx]]
-        data.append(avg_data[j])
-        writer.writerow(data)
\ No newline at end of file
+    return int(left_min_index[0]), int(max_index[0]), int(right_min_index[0])
+
+def average_signal(segments, dt, n_groups=1, prominence=0.5, smooth_window=5, keep=None):
+    """
+    Averaged signal of a run (dt between readings in seconds), keep selects the segments as in average_segments
+
+    Returns:
+        tuple: Time within a segment (microseconds), the averaged signal (n_groups x segment length)
+            and the extrema of every averaged signal as returned by extract_extrema_batch.
+    """
+
+    average = average_segments(segments, n_groups, keep)
+    time = np.arange(average.shape[1]) * dt * 1e6
+
+    return time, average, extract_extrema_batch(average, prominence, smooth_window)
+
+def average_tables(segments, dt, **kwargs):
+    """
+    Averaged signal and its peak as tables, the layout of average_data.csv and average_data_peak.csv
+    kwargs are passed to average_signal. The peak table is empty if the averaged signal has no peak.
+    """
+
+    time, average, (left_min_idx, peak_idx, right_min_idx) = average_signal(segments, dt, **kwargs)
+
+    df_average = pd.DataFrame({"Time(microseconds)": time[:-1], "Average Signal": average[0, :-1]})
+
+    peak = np.arange(peak_idx[0], right_min_idx[0]) if left_min_idx[0] >= 0 and right_min_idx[0] >= 0 else np.arange(0)
+    df_peak = pd.DataFrame({"Time(microseconds)": time[peak] - time[peak_idx[0]], "Average Signal": average[0, peak]})
+
+    return df_average, df_peak
+
+def plot_average(time, average, left_min_idx, peak_idx, right_min_idx):
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(8, 5))
+    plt.plot(time, average, marker='o', linestyle='-', color='b', label="Average Signal")
+
+    plt.axvline(x=time[left_min_idx], color='y', linestyle='--', linewidth=2, label="Local min (left)")
+    plt.axvline(x=time[right_min_idx], color='r', linestyle='--', linewidth=2, label="Local min (right)")
+    plt.axvline(x=time[peak_idx], color='g', linestyle='--', linewidth=2, label="Local max")
+    # Labels and title
+    plt.xlabel("Time us")
+    plt.ylabel("Raw Intensity")
+    plt.legend()
+    plt.grid(True)
+
+    # Show plot
+    plt.show()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Average the segments of a run and cut out the peak of the average")
+    parser.add_argument("file_name", help="raw store (data_output.dls) or csv")
+    parser.add_argument("--segments", type=int, default=None, help="average only the first segments")
+    parser.add_argument("--plot", action="store_true")
+    args = parser.parse_args()
+
+    segments, framing = load_segments(args.file_name)
+    segments = segments[:args.segments]
+
+    df_average, df_peak = average_tables(segments, framing.dt)
+    df_average.to_csv("average_data.csv", index=False)
+    df_peak.to_csv("average_data_peak.csv", index=False)
+
+    if args.plot:
+        time, average, extrema = average_signal(segments, framing.dt)
+        if np.all([index[0] >= 0 for index in extrema]):
+            plot_average(time, average[0], *[index[0] for index in extrema])
@@ -1,24 +1,91 @@
-from data_processing.csv_conversion import convert_to_peaks
+from data_processing.csv_conversion import peak_matrix, set_names, NUM_SETS
+from data_processing.correlator import multi_tau_correlate, fft_correlate
+from data_processing.framing import load_segments
+from data_processing.data_format import average_tables
 import matplotlib.pyplot as plt
 import pandas as pd
 from data_processing.dlsAnalyzer import *
 
-def post_processing():
+def post_processing(file_name, output_prefix=None, method="peaks"):
+    """
+    Analyze a run (raw store or csv), returns the results and autocorrelation tables
+    They are written to <output_prefix>results.csv and <output_prefix>autocorrelation_data.csv
+    only if output_prefix is given ("" for results.csv), along with the averaged signal of the run
+    (<output_prefix>average_data.csv and <output_prefix>average_data_peak.csv, see data_format)
+    method is "peaks" (fit the peaks cut out of the readings), "correlation" (fit the multi-tau g2)
+    or "fft" (fit the g2 at every lag, for offline re-analysis)
+    """
+    # Every complete batch of the run, framed from its metadata
+    segments, framing = load_segments(file_name)
+    # Leave out the segments hit by dust or stray light, read chunk by chunk from the run (never copied whole)
+    spikes = spike_segments(segments)
+    keep   = ~spikes
+    if np.any(spikes):
+        print(f"Rejected {np.count_nonzero(spikes)} of {len(segments)} segments with spikes")
+    if method == "correlation":
+        d = analyze_correlation(*multi_tau_correlate(segments, framing.dt, n_curves=NUM_SETS, keep=keep))
+    elif method == "fft":
+        d = analyze_correlation(*fft_correlate(segments, framing.dt, n_curves=NUM_SETS, keep=keep))
+    else:
+        d = analyze(segments, framing.dt, keep)
+    df_results, df_corr = results_tables(d)
+
+    if output_prefix is not None:
+        df_corr.to_csv(f"{output_prefix}autocorrelation_data.csv", index=False)
+        df_results.to_csv(f"{output_prefix}results.csv", index=False)
+
+        df_average, df_peak = average_tables(segments, framing.dt, keep=keep)
+        df_average.to_csv(f"{output_prefix}average_data.csv", index=False)
+        df_peak.to_csv(f"{output_prefix}average_data_peak.csv", index=False)
+
+    return df_results, df_corr
+
+def analyze(segments, dt, keep=None):
+    """
+    Fit the raw readings of a run (n segments x segment length, dt between readings in seconds),
+    keep is a boolean per segment to fit (None for all of them)
+    Returns the fitted dls_experiment
+    """
     # convert data to peaks
-    convert_to_peaks("data_output_example.csv")
+    return analyze_peaks(*peak_matrix(segments, dt * 1e6, keep=keep))
+
+def analyze_peaks(subset_time, subsets):
+    """
+    Fit peak curves (time in microseconds, one column per curve) from csv_conversion.peak_matrix or StreamingPeaks
+    Returns the fitted dls_experiment
+    """
     # Initialize plots
     # plt.rcParams['figure.figsize'] = [10, 5]
 
     # Start dls analyzer
     print("Initializing DLS...")
     dls               = dlsAnalyzer()
-    l                 = dls.loadExperiment("subsets.csv","test")
+    l                 = dls.loadExperimentArrays(subset_time, subsets, set_names(subsets.shape[1]), "test")
     d                 = dls.experimentsOri["test"] 
 
+    return fit(d)
+
+def analyze_correlation(time, autocorrelation):
+    """
+    Fit g2 curves (time in seconds, one column per curve) from data_processing.correlator
+    Returns the fitted dls_experiment
+    """
+    print("Initializing DLS...")
+    dls               = dlsAnalyzer()
+    l                 = dls.loadExperimentCorrelation(time, autocorrelation, set_names(autocorrelation.shape[1]), "test")
+    d                 = dls.experimentsOri["test"]
+
+    return fit(d)
+
+def fit(d):
+    """
+    Fit the size distribution of every curve of a loaded dls_experiment
+    """
     d.lambda0         = 635                #  Laser wavelength in nanometers
     d.scatteringAngle = 90 / 180 * np.pi  #  Angle of detection in radians
     d.getQ()                               #  Calculate the Bragg wave vector
     d.createFittingS_space(0.09,1e6,200)   #  Discretize the decay rate space we will use for the fitting
+    d.rejectOutliers()                     #  Leave out the curves with an outlying beta or baseline
     d.setAutocorrelationData()   
 
     # Estimate the intercept of the second order autocorrelation curves
@@ -40,12 +107,17 @@ def post_processing():
     print("Calculating correlation prediction...")
     d.predictAutocorrelationCurves()
 
+    return d
+
+def results_tables(d):
+    """
+    Autocorrelation (predicted and measured, first set) and size distribution tables of a fitted dls_experiment
+    """
     df_corr = pd.DataFrame({
     "Time": d.time,
     "Autocorrelation Predicted": d.autocorrelationPredicted[:, 0],
     "Autocorrelation Actual": d.autocorrelation[:, 0]
     })
-    df_corr.to_csv("autocorrelation_data.csv", index=False)
     # Plot fitted data
     # plt.xscale("log")
     # plt.plot(d.time,d.autocorrelationPredicted[:,0],'red')
@@ -97,8 +169,7 @@ def post_processing():
     # Convert to DataFrame
     df_results = pd.DataFrame(rows, columns=header)
 
-    # Save to CSV
-    df_results.to_csv("results.csv", index=False)
+    return df_results, df_corr
 
         
         # plt.plot(d.hrs[data_range[0]:data_range[1]],d.contributionsGuess[data_set][data_range[0]:data_range[1]], label=('Data Set ' + str(data_set) + " d = " + str(dia)))
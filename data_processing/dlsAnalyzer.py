@@ -44,6 +44,13 @@ class dls_experiment:
         # Parameters required for fitting
         self.s_space, self.ds, self.hrs, self.weights     = None, None, None, None
 
+        # Solver of the Tikhonov regularization, see TikhonovSystem
+        self.solverMethod = "auto"
+        self.warmStart    = True # Sweep the alphas along the regularization path (TikhonovSystem.solve_path)
+        self.batchCurves  = 8    # Sweep the alphas of all the curves together (TikhonovBatch) from this many curves on, None to never
+                                 # Only with warmStart: a cold solve is faster curve by curve
+        self.kernelSVDs   = {}   # Kernel SVD of the "svd" solver per curve length, kept for every stage of the fit
+
         # Parameters required for fitting (L curve criteria)
         self.alphaVec, self.optimalAlpha, self.alphaOptIdx  = None, None, None
 
@@ -67,14 +74,75 @@ class dls_experiment:
         """
 
         self.time, self.autocorrelationOriginal, sampleNames = readWyatFile(file)
-        
+
+        self.setSampleInfo(sampleNames)
+
+        return None
+
+    def loadArrays(self,time,autocorrelation,sampleNames):
+
+        """
+        Load data already in memory, with the layout of a Wyat file
+        time            - in microseconds
+        autocorrelation - one column per sample
+        sampleNames     - one per column
+        """
+
+        self.time, self.autocorrelationOriginal, sampleNames = readWyatArrays(time, autocorrelation, sampleNames)
+
+        self.setSampleInfo(sampleNames)
+
+        return None
+
+    def loadCorrelation(self,time,autocorrelation,sampleNames):
+
+        """
+        Load g2 curves computed by data_processing.correlator
+        time            - in seconds, one value per lag
+        autocorrelation - g2, one column per sample
+        sampleNames     - one per column
+        """
+
+        self.time, self.autocorrelationOriginal = np.asarray(time), np.asarray(autocorrelation)
+
+        self.setSampleInfo(sampleNames)
+
+        return None
+
+    def setSampleInfo(self,sampleNames):
+
         self.sampleInfo = pd.DataFrame({"conditions":sampleNames,"read":1,"scan":1,"include":True})
+        self.kernelSVDs = {} # The kernels change with the time grid
 
         self.lambda0         = 635 # in nm
         self.scatteringAngle = 90 / 180 * np.pi # radians
 
         return None
 
+    def rejectOutliers(self,betaTolerance=0.2,baselineTolerance=0.25,zThreshold=4):
+
+        """
+
+        Exclude (through self.sampleInfo.include) the curves with an outlying intercept or a
+        baseline that rises again, see outlier_curves. The reason is kept in self.sampleInfo.rejected
+
+        Run before setAutocorrelationData() ! At least one curve is always kept.
+
+        """
+
+        betaOutlier, baselineOutlier = outlier_curves(self.autocorrelationOriginal,self.time,betaTolerance,baselineTolerance,zThreshold)
+        rejected = betaOutlier | baselineOutlier
+
+        self.sampleInfo["rejected"] = np.where(betaOutlier, "beta", np.where(baselineOutlier, "baseline", ""))
+
+        if np.all(rejected[self.sampleInfo.include]):
+            print("All curves are outliers, none rejected")
+            return None
+
+        self.sampleInfo["include"] = self.sampleInfo.include & ~rejected
+
+        return None
+
     def setAutocorrelationData(self):
 
         """
@@ -126,6 +194,7 @@ class dls_experiment:
         self.s_space     = np.logspace(np.log10(sUpLimitLow),np.log10(sUpLimitHigh), n) 
 
         self.ds          = diffusion_from_inverse_decay_rate(self.s_space,self.q)
+        self.kernelSVDs  = {} # The kernels change with the s_space
         self.hrs         = hydrodynamic_radius(self.ds ,self.temperature,self.viscosity)*1e9  # In nanometers
 
         return None
@@ -169,7 +238,8 @@ class dls_experiment:
 
         # Return the fitted contributions and residuals of the first order autocorrelation function
         self.contributionsGuess, self.residualsG1, _   = get_contributios_prior(
-            self.g1[selectedTimes,:],self.time[selectedTimes],self.s_space,self.betaGuess,alpha) 
+            self.g1[selectedTimes,:],self.time[selectedTimes],self.s_space,self.betaGuess,alpha,method=self.solverMethod,
+            svds=self.kernelSVDs) 
 
         return None
 
@@ -192,22 +262,16 @@ class dls_experiment:
 
         selectedTimes = self.time < (timeLimit / 1e6)
 
-        curvesResidualNorm, curvesPenaltyNorm = [],[]
-
         self.alphaVec           = alphaVec
 
-        # Iterate over the vector with different values of alpha
-        for alpha in alphaVec:
+        # The kernel and the Tikhonov systems are assembled once for all the values of alpha
+        curvesResidualNorm, curvesPenaltyNorm = get_contributions_path(
+            self.g1[selectedTimes,:],self.time[selectedTimes],self.s_space,alphaVec,method=self.solverMethod,
+            warmStart=self.warmStart,batch=self.warmStart and self.batchCurves is not None and self.g1.shape[1] >= self.batchCurves,
+            svds=self.kernelSVDs)
 
-            _ , residualNorm, penaltyNorm = get_contributios_prior(
-                self.g1[selectedTimes,:],self.time[selectedTimes],
-                self.s_space,self.betaGuess,alpha) 
-          
-            curvesResidualNorm.append(residualNorm) # List (one element per alpha) of lists (one element per curve)
-            curvesPenaltyNorm.append(penaltyNorm)   # List (one element per alpha) of lists (one element per curve)
-
-        self.curvesResidualNorm = np.array(curvesResidualNorm) # One row per alpha, one column per curve
-        self.curvesPenaltyNorm  = np.array(curvesPenaltyNorm)  # One row per alpha, one column per curve
+        self.curvesResidualNorm = curvesResidualNorm # One row per alpha, one column per curve
+        self.curvesPenaltyNorm  = curvesPenaltyNorm  # One row per alpha, one column per curve
 
         return None
 
@@ -346,6 +410,38 @@ class dlsAnalyzer:
         
         return "Data could not be loaded"
 
+    def loadExperimentCorrelation(self,time,autocorrelation,sampleNames,name):
+
+        """
+        Append one experiment to experimentsOri from g2 curves (see dls_experiment.loadCorrelation)
+        """
+
+        if name in self.experimentNames:
+
+            return "Experiment name already selected!"
+
+        self.experimentsOri[name] = dls_experiment()
+        self.experimentsOri[name].loadCorrelation(time,autocorrelation,sampleNames)
+        self.experimentNames.append(name)
+
+        return "Data loaded successfully!!!"
+
+    def loadExperimentArrays(self,time,autocorrelation,sampleNames,name):
+
+        """
+        Append one experiment to experimentsOri from data in memory (see dls_experiment.loadArrays)
+        """
+
+        if name in self.experimentNames:
+
+            return "Experiment name already selected!"
+
+        self.experimentsOri[name] = dls_experiment()
+        self.experimentsOri[name].loadArrays(time,autocorrelation,sampleNames)
+        self.experimentNames.append(name)
+
+        return "Data loaded successfully!!!"
+
     def deleteExperiment(self,name):
 
         self.experimentNames.remove(name)
@@ -0,0 +1,139 @@
+"""
+Framing: cut a run into segments of contiguous readings, following the run's own metadata
+
+The firmware takes its readings in batches (numReadings in upload_DLS.ino, SUBSET_LENGTH in
+connect_arduino.py) and then pauses to send them, so only readings within a batch are evenly
+spaced. The raw store records the batch length in its header; csv runs predate the header and
+use the firmware default. Every complete segment of the run is used.
+"""
+
+import numpy as np
+
+from data_processing.raw_data import open_raw, load_raw, iter_raw, RAW_HEADER_DTYPE, RAW_MAGIC
+
+DEFAULT_SEGMENT_LENGTH = 800  # Batch length of the firmware, for runs without a header
+CHUNK_SEGMENTS         = 1024 # Segments per chunk read by iter_segments
+
+class RunFraming:
+
+    """
+    Segment layout of a run
+
+    segment_length - readings per segment
+    n_segments     - complete segments in the run
+    dt             - average time between readings within a segment, in seconds
+    """
+
+    def __init__(self, segment_length, n_segments, dt):
+
+        self.segment_length = segment_length
+        self.n_segments     = n_segments
+        self.dt             = dt
+
+    def __repr__(self):
+
+        return f"RunFraming(segment_length={self.segment_length}, n_segments={self.n_segments}, dt={self.dt:.4g})"
+
+def run_segment_length(file_name):
+
+    """
+    Batch length of a run: from the raw store header, DEFAULT_SEGMENT_LENGTH for csv runs
+    """
+
+    if file_name.endswith('.csv'):
+        return DEFAULT_SEGMENT_LENGTH
+
+    header = np.fromfile(file_name, dtype=RAW_HEADER_DTYPE, count=1)
+    if len(header) == 0 or header['magic'][0] != RAW_MAGIC:
+        raise ValueError(f"{file_name} is not a raw DLS file")
+
+    return int(header['subset_length'][0])
+
+def frame(values, segment_length):
+
+    """
+    (n segments x segment_length) view of a 1D stream, dropping an incomplete last segment
+
+    No copy is made for a contiguous stream (a memmap or an array from load_raw).
+    """
+
+    values    = np.asarray(values)
+    nSegments = len(values) // segment_length
+
+    return values[:nSegments * segment_length].reshape(nSegments, segment_length)
+
+def kept_segments(nSegments, keep=None):
+
+    """
+    Indices of the segments to use, all nSegments if keep (a boolean per segment, e.g. the segments without
+    spikes) is None. Reading a memory-mapped run at these indices chunk by chunk never copies the whole run.
+    """
+
+    return np.arange(nSegments) if keep is None else np.flatnonzero(keep)
+
+def frame_run(time, y_data, segment_length=DEFAULT_SEGMENT_LENGTH):
+
+    """
+    Segments of a run already loaded with load_raw (time in microseconds), and its RunFraming
+    """
+
+    segments = frame(y_data, segment_length)
+    times    = frame(time, segment_length)
+
+    # Average time between readings (the time stamps are rounded to microseconds)
+    dt = np.mean(times[:, -1] - times[:, 0]) / (segment_length - 1) / 1e6 if len(times) else np.nan
+
+    return segments, RunFraming(segment_length, len(segments), dt)
+
+def load_segments(file_name, segment_length=None):
+
+    """
+    Segments of a run file and its RunFraming, segment_length defaults to the run's batch length
+
+    For a raw store framed at its own batch length the segments are a read-only view into the
+    memory-mapped file, nothing is loaded or copied until they are used.
+    """
+
+    batch_length = run_segment_length(file_name)
+    segment_length = batch_length if segment_length is None else segment_length
+
+    if file_name.endswith('.csv') or segment_length != batch_length:
+        time, y_data, _ = load_raw(file_name)
+        return frame_run(time, y_data, segment_length)
+
+    records = open_raw(file_name)
+    dt      = np.mean(records['step']) / 1e6 if len(records) else np.nan
+
+    return records['samples'], RunFraming(segment_length, len(records), dt)
+
+def iter_segments(file_name, segment_length=None, chunk_segments=CHUNK_SEGMENTS):
+
+    """
+    load_segments chunk by chunk: yields the segments and RunFraming of up to chunk_segments segments at a time
+
+    Only one chunk is held in memory, a raw store framed at its own batch length is read through the memory map.
+    Segments never span two chunks, readings left over at the end of a chunk start the next one.
+    """
+
+    batch_length = run_segment_length(file_name)
+    segment_length = batch_length if segment_length is None else segment_length
+
+    if not file_name.endswith('.csv') and segment_length == batch_length:
+        records = open_raw(file_name)
+        for first in range(0, len(records), chunk_segments):
+            chunk = records[first:first + chunk_segments]
+            yield chunk['samples'], RunFraming(segment_length, len(chunk), np.mean(chunk['step']) / 1e6)
+        return
+
+    time, y_data = None, None
+    for chunk_time, chunk_values, _ in iter_raw(file_name, chunk_segments * segment_length):
+
+        if time is not None:
+            chunk_time, chunk_values = np.concatenate((time, chunk_time)), np.concatenate((y_data, chunk_values))
+        time, y_data = chunk_time, chunk_values
+        segments, framing = frame_run(time, y_data, segment_length)
+        if framing.n_segments:
+            yield segments, framing
+
+        used = framing.n_segments * segment_length
+        time, y_data = time[used:], y_data[used:]
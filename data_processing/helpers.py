@@ -2,10 +2,32 @@ import numpy as np
 
 from scipy import spatial
 
+from scipy.ndimage       import median_filter
+
 from scipy.optimize      import nnls
 
+from scipy.linalg        import cholesky, solve, solve_triangular
+
 from math import acos, degrees
 
+# Viscosity of common solvents in mPa·s (divide by 1000 for pascal-second)
+VISCOSITY_VALUES = {
+    "Water": 0.89,
+    "Ethanol": 1.2,
+    "Methanol": 0.55,
+    "Acetone": 0.32,
+    "Toluene": 0.59,
+    "Glycerol": 945,
+    "DMF (Dimethylformamide)": 0.92,
+    "DMSO (Dimethyl sulfoxide)": 1.99,
+    "Chloroform": 0.57,
+    "Hexane": 0.31,
+    "Benzene": 0.65,
+    "THF (Tetrahydrofuran)": 0.46,
+}
+
+SVD_TOLERANCE  = 1e-10 # Singular values of the kernel kept by the "svd" solver, relative to the largest
+
 def get_q(lambda0,refractiveIndex,scatteringAngle):
     
     # Calculate the Bragg wave vector
@@ -97,6 +119,515 @@ def get_beta_prior(g2,time):
         
     return betaPrior
 
+def robust_z(values):
+
+    """
+    Robust z-score of every row of values (n x m) against the median and MAD of its column
+    """
+
+    median = np.median(values, axis=0)
+    mad    = 1.4826 * np.median(np.abs(values - median), axis=0)
+
+    return (values - median) / np.where(mad > 0, mad, np.inf)
+
+def spike_segments(segments, threshold=30, window=9, saturation=1023, chunk=2048):
+
+    """
+    Requires -
+                segments matrix n segments * segment length (raw readings)
+
+    Returns a boolean per segment, True where it holds a spike (a dust particle crossing the beam or stray
+    light with the lid open): a reading more than threshold times the segment's own noise above the running
+    median of the window readings around it. Every segment is scored against its own baseline, so the slow
+    intensity changes of large particles (or slow dust, left to outlier_curves) don't count as spikes.
+    The noise is the robust spread of the residuals of the readings below saturation (the ADC maximum),
+    so a segment clipped for most of its length doesn't get a zero noise.
+    """
+
+    spikes = []
+
+    for first in range(0, len(segments), chunk):
+
+        x        = np.asarray(segments[first:first + chunk], dtype=np.float64)
+        residual = x - median_filter(x, size=(1, window), mode="nearest")
+        below    = np.where(x < saturation, np.abs(residual), np.nan)
+        counted  = np.any(x < saturation, axis=1)
+        noise    = np.ones(len(x))
+        noise[counted] = np.maximum(1.4826 * np.nanmedian(below[counted], axis=1), 1) # At least one ADC count
+
+        spikes.append(residual.max(axis=1) > threshold * noise)
+
+    return np.concatenate(spikes) if spikes else np.zeros(0, dtype=bool)
+
+def outlier_curves(g2,time,betaTolerance=0.2,baselineTolerance=0.25,zThreshold=4):
+
+    """
+    Requires -
+                g2 matrix n*m
+                Time vector of length n
+
+    Returns two booleans per curve:
+        beta     - the intercept estimate (get_beta_prior) is not positive, or both further than
+                   betaTolerance (relative) from the median of the curves and a robust outlier of them
+                   (z-score above zThreshold). Slow dust in part of the run lowers the intercept of its curves
+        baseline - the curve rises again above its running minimum (a decay that isn't monotone) by more
+                   than baselineTolerance * beta and by more than zThreshold times its own noise (the robust
+                   spread of its last quarter of lags around their trend), whatever the number of curves.
+                   With 3 curves or more, also a baseline (second half of the lags) above the other curves,
+                   its mean robust z-score against them above zThreshold: slow dust contributions, drifts
+
+    Comparing the curves with each other scales with their noise, which grows as the run is split in more curves
+    """
+
+    # Curves with g2 <= 1 in the first 200 microseconds have no log to fit
+    valid = np.all(g2[time < 200*1e-6,:] > 1, axis=0)
+    beta  = np.full(g2.shape[1], np.nan)
+    if np.any(valid):
+        beta[valid] = get_beta_prior(g2[:,valid],time)
+
+    betaOutlier = ~(beta > 0)
+    if np.count_nonzero(~betaOutlier) >= 3:
+        median       = np.median(beta[~betaOutlier])
+        z            = np.zeros_like(beta)
+        z[~betaOutlier] = robust_z(beta[~betaOutlier])
+        betaOutlier |= (np.abs(beta - median) > betaTolerance * median) & (np.abs(z) > zThreshold)
+
+    # Noise: spread of the last quarter of lags around a straight line in log(time), so a baseline rising
+    # steadily at the end of the curve doesn't count as noise
+    tail            = slice(3*len(g2)//4, None)
+    logTime         = np.log(time[tail]) - np.mean(np.log(time[tail]))
+    trend           = np.column_stack((logTime, np.ones(len(logTime))))
+    residual        = g2[tail,:] - trend.dot(np.linalg.lstsq(trend, g2[tail,:], rcond=None)[0])
+    noise           = 1.4826 * np.median(np.abs(residual - np.median(residual, axis=0)), axis=0)
+    rise            = np.max(g2 - np.minimum.accumulate(g2, axis=0), axis=0)
+    baselineOutlier = (rise > baselineTolerance * beta) & (rise > zThreshold * noise)
+
+    if g2.shape[1] >= 3:
+        baselineOutlier |= robust_z(g2[len(g2)//2:,:].T).mean(axis=1) > zThreshold
+
+    return betaOutlier, baselineOutlier
+
+def second_difference_matrix(cols):
+
+    """
+    Second order derivative matrix M (cols x cols), the first and last rows are zero
+    """
+
+    M = np.zeros((cols,cols))
+    i = np.arange(1,cols-1)
+    M[i,i-1] = -1
+    M[i,i]   =  2
+    M[i,i+1] = -1
+
+    return M
+
+def nnls_gram(G,h,x0=None,maxiter=None):
+
+    """
+
+    Solve x / minimize x'Gx - 2h'x subject to x >= 0, G symmetric positive (semi)definite
+
+    This is the non-negative least squares problem min ||Cx - d|| written with its normal equations
+    (G = C'C and h = C'd), solved with the active set method of Lawson and Hanson (the one of
+    scipy.optimize.nnls). Every step only solves the system of the passive (positive) variables.
+
+    x0 - a non negative starting point, typically the solution of a neighbouring problem: its positive
+         variables are the starting passive set, so only the variables that change sign are visited
+
+    Raises RuntimeError if it doesn't converge in maxiter steps, as scipy.optimize.nnls does
+
+    """
+
+    n       = len(h)
+    maxiter = 3*n if maxiter is None else maxiter
+    tol     = 10*n*np.finfo(float).eps*max(np.max(np.abs(np.diag(G))),1)
+
+    x       = np.zeros(n) if x0 is None else np.array(x0,dtype=float)
+    passive = x > 0
+    check   = np.any(passive) # Start by making the passive set of x0 optimal
+
+    for _ in range(maxiter):
+
+        if not check:
+            # Move the variable with the largest (positive) gradient to the passive set
+            w    = h - G.dot(x)
+            free = ~passive & (w > tol)
+            if not np.any(free):
+                break
+            passive[np.argmax(np.where(free, w, -np.inf))] = True
+        check = False
+
+        while np.any(passive):
+
+            z          = np.zeros(n)
+            z[passive] = passive_solve(G,h,passive)
+
+            if np.all(z[passive] > 0):
+                x = z
+                break
+
+            # Step towards z until a variable hits zero, and release it
+            blocking    = passive & (z <= 0)
+            step        = np.min(x[blocking] / (x[blocking] - z[blocking]))
+            x           = x + step*(z - x)
+            passive    &= x > tol
+            x[~passive] = 0
+
+    else:
+        raise RuntimeError("nnls_gram: maximum number of iterations reached")
+
+    return x
+
+def passive_solve(G,h,passive):
+
+    """
+    Unconstrained minimizer of x'Gx - 2h'x over the passive variables
+    """
+
+    Gp = G[np.ix_(passive,passive)]
+
+    try:
+        return solve(Gp,h[passive],assume_a='pos',check_finite=False)
+    except np.linalg.LinAlgError:
+        return np.linalg.lstsq(Gp,h[passive],rcond=None)[0]
+
+def nnls_batch(kernel,weights,penalty,alphas,H,X0=None,gram=None,maxiter=None):
+
+    """
+
+    nnls_gram of m problems sharing one kernel A (n rows x n s), the problem of row i of H (m x n s) has
+    G = A' diag(weights[i]) A + alphas[i]*penalty and h = H[i]
+
+    weights - weight of every row of the kernel (the W of TikhonovSystem) for every problem (m x n rows),
+              zero for the rows a problem doesn't use (the times after the first NaN of its curve)
+    penalty - M'M (n s x n s), the same for every problem
+    X0      - non negative starting points (m x n s), see nnls_gram
+    gram    - A' diag(weights[i]) A of every problem (m x n s x n s), computed if not given: pass it
+              to solve the same problems for many alphas
+
+    Every problem follows the same Lawson and Hanson steps as nnls_gram, the steps of all the problems
+    still running are taken together: the gradients are two products with the shared kernel and the
+    passive systems one batched solve (passive_solve_batch). The Python loop is paid once per step for
+    all the problems instead of once per problem.
+
+    """
+
+    m, n    = H.shape
+    alphas  = np.broadcast_to(np.asarray(alphas,dtype=float),(m,))
+    gram    = np.matmul(kernel.T*weights[:,None,:],kernel) if gram is None else gram
+    maxiter = 3*n if maxiter is None else maxiter
+    diag    = np.diagonal(gram,axis1=1,axis2=2) + alphas[:,None]*np.diag(penalty)
+    tol     = 10*n*np.finfo(float).eps*np.maximum(np.max(np.abs(diag),axis=1),1)
+
+    X       = np.zeros((m,n)) if X0 is None else np.array(X0,dtype=float)
+    passive = X > 0
+    check   = np.any(passive,axis=1) # Start by making the passive set of X0 optimal
+    running = np.ones(m,dtype=bool)
+
+    for _ in range(maxiter):
+
+        rows = np.flatnonzero(running & ~check)
+        if len(rows):
+            # Move the variable with the largest (positive) gradient to the passive set
+            x    = X[rows]
+            W    = H[rows] - (x.dot(kernel.T)*weights[rows]).dot(kernel) - alphas[rows,None]*x.dot(penalty)
+            free = ~passive[rows] & (W > tol[rows,None])
+            more = np.any(free,axis=1)
+            running[rows[~more]] = False
+            passive[rows[more],np.argmax(np.where(free[more],W[more],-np.inf),axis=1)] = True
+        check[:] = False
+
+        if not np.any(running):
+            break
+
+        inner = running & np.any(passive,axis=1)
+        while np.any(inner):
+
+            rows = np.flatnonzero(inner)
+            P    = passive[rows]
+            Z    = passive_solve_batch(gram,penalty,alphas,H,rows,P)
+
+            done              = np.all(Z > 0,axis=1,where=P)
+            X[rows[done]]     = Z[done]
+            inner[rows[done]] = False
+
+            # Step towards Z until a variable hits zero, and release it
+            rows, P, Z  = rows[~done], P[~done], Z[~done]
+            x           = X[rows]
+            blocking    = P & (Z <= 0)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                step    = np.min(np.where(blocking,x / (x - Z),np.inf),axis=1)
+            x           = x + step[:,None]*(Z - x)
+            P          &= x > tol[rows,None]
+            x[~P]       = 0
+
+            X[rows], passive[rows] = x, P
+            inner[rows] = np.any(P,axis=1)
+
+    return X
+
+def passive_solve_batch(gram,penalty,alphas,H,rows,passive):
+
+    """
+    passive_solve of the problems rows of nnls_batch, passive holds their passive sets (one row each)
+    Returns the solutions, zero outside the passive variables
+
+    The passive variables of every problem are moved first and the systems padded with the identity
+    up to the largest passive set, so all of them are solved with one batched call
+    """
+
+    m, n  = passive.shape
+    order = np.argsort(~passive,axis=1,kind='stable')[:,:np.max(np.sum(passive,axis=1))] # Passive variables first, in order
+    used  = np.take_along_axis(passive,order,axis=1)
+    k     = order.shape[1]
+
+    # Passive blocks of gram + alpha*penalty, taken from the flattened matrices
+    block = order[:,:,None]*n + order[:,None,:]
+    Gp    = gram.reshape(-1).take(block + (rows*n*n)[:,None,None]) + alphas[rows,None,None]*penalty.reshape(-1).take(block)
+    Gp    = np.where(used[:,:,None] & used[:,None,:],Gp,0)
+    Gp[:,np.arange(k),np.arange(k)] += ~used
+    hp    = np.where(used,np.take_along_axis(H[rows],order,axis=1),0)
+
+    try:
+        zp = solve(Gp,hp[...,None],assume_a='pos',check_finite=False)[...,0]
+    # One of the systems isn't positive definite (or scipy can't solve batches), one by one then
+    except (np.linalg.LinAlgError,ValueError):
+        zp = np.zeros((m,k))
+        for i, row in enumerate(rows):
+            zp[i,used[i]] = passive_solve(gram[row] + alphas[row]*penalty,H[row],passive[i])
+
+    Z = np.zeros((m,n))
+    np.put_along_axis(Z,order,np.where(used,zp,0),axis=1)
+
+    return Z
+
+def kernel_svd(fidelity,tolerance=SVD_TOLERANCE):
+
+    """
+    Truncated SVD U S V' of a weighted kernel, keeping the singular values above tolerance times the largest
+
+    The SVD is kept by the TikhonovSystem that needs it, which is shared by every alpha and every curve
+    of the same length (curve_systems)
+
+    Returns U (n rows x k), the k singular values and V' (k x n s)
+    """
+
+    U, singularValues, Vt = np.linalg.svd(fidelity,full_matrices=False)
+    k = int(np.sum(singularValues > tolerance*singularValues[0]))
+
+    return U[:,:k], singularValues[:k], Vt[:k]
+
+def constrained_kernel(kernel,W):
+
+    """
+    Kernel and weights with the constraint rows of tikhonov_Phillips_reg appended: the sum of
+    contributions equal to 1, the initial and last values equal to 0 (the data of these rows is [1,0,0])
+    """
+
+    W      = np.append(W,np.array([1e3,1e3,1e3])) # weight to force the initial and last values equal to 0, and the sum of contributions equal to 1
+
+    rowToForceInitialValue    = np.zeros(kernel.shape[1])
+    rowToForceInitialValue[0] = 1
+    rowToForceLastValue       = np.flip(rowToForceInitialValue)
+
+    kernel = np.vstack([kernel,np.ones(kernel.shape[1]),rowToForceInitialValue,rowToForceLastValue])
+
+    return kernel, W
+
+class TikhonovSystem:
+
+    """
+
+    The system solved by tikhonov_Phillips_reg, assembled once for a kernel and weights
+
+    The weighted kernel, the constraint rows and the penalty matrix only depend on the time grid, the
+    s_space and the weights, so they are shared by every alpha and every curve with the same grid:
+    solve() only rescales the penalty block by sqrt(alpha).
+
+    method - "nnls" solves the full (n time + 3 + n s) x n s system with scipy.optimize.nnls
+             "gram" solves the n s x n s normal equations (A'WA + alpha M'M, A'Wb): with the Cholesky
+             factor R'R = A'WA + alpha M'M the problem is the same as nnls on R and R'^-1 A'Wb.
+             A'WA and M'M are computed once and A'Wb once per curve. Alphas too small for the
+             factorization fall back to "nnls". Faster once there are clearly more times than s values
+             "svd" solves nnls on the kernel compressed to its largest singular values (kernel_svd):
+             the fidelity rows become the k x n s block S V' and the data U'Wb, the same solution within
+             the truncation. The exponential kernel has far fewer significant singular values than times,
+             so every solve has fewer rows than "nnls". The SVD is only computed by the first solve()
+             (solve_path works on the Gram matrix and never needs it), or taken from svds[svdKey]
+             when it was already computed for the same kernel and weights
+    "auto"   - "gram" when the kernel has more than twice as many rows as columns, "nnls" otherwise
+               ("svd" only pays for its SVD over many cold solves of one kernel, the warm-started
+               alpha sweep of a fit doesn't use it)
+
+    """
+
+    def __init__(self,kernel,W,method="nnls",svds=None,svdKey=None):
+
+        kernel, W = constrained_kernel(kernel,W)
+
+        self.sqrtW    = np.sqrt(W)
+        self.fidelity = self.sqrtW[:, None] * kernel # Fidelity term
+        self.M        = second_difference_matrix(kernel.shape[1])
+
+        if method == "auto":
+            method = "gram" if kernel.shape[0] > 2*kernel.shape[1] else "nnls"
+
+        # Compressed fidelity rows S V' for "svd", built by compress() on the first solve
+        self.U        = None
+        self.svds     = svds
+        self.svdKey   = svdKey
+
+        # Fidelity rows on top of the penalty rows, the penalty rows are rescaled for every alpha
+        self.nFidelity = len(self.fidelity)
+        self.C         = np.concatenate([self.fidelity, self.M], axis=0)
+        self.d         = np.zeros(self.C.shape[0])
+        self.alpha     = 1
+        self.method    = method
+
+        if method == "gram":
+            self.gram    = self.fidelity.T.dot(self.fidelity)
+            self.penalty = self.M.T.dot(self.M)
+            self.data    = None # Last curve, with its A'Wb
+            self.factorAlpha = None # alpha of the Cholesky factor R
+
+    def compress(self):
+
+        """
+        Replace the fidelity rows of C by S V' of kernel_svd, the data is projected onto U (see rhs)
+        """
+
+        if self.svds is not None and self.svdKey in self.svds:
+            self.U, singularValues, Vt = self.svds[self.svdKey]
+        else:
+            self.U, singularValues, Vt = kernel_svd(self.fidelity)
+            if self.svds is not None:
+                self.svds[self.svdKey] = (self.U, singularValues, Vt)
+
+        fidelity       = singularValues[:, None] * Vt
+        self.nFidelity = len(fidelity)
+        self.C         = np.concatenate([fidelity, np.sqrt(self.alpha) * self.M], axis=0)
+        self.d         = np.zeros(self.C.shape[0])
+
+        return None
+
+    def weighted(self,data):
+
+        """
+        Weighted measurements and constraint values
+        """
+
+        return self.sqrtW*np.append(data,np.array([1,0,0]))
+
+    def rhs(self,data):
+
+        """
+        Weighted measurements and constraint values (projected onto U for "svd"), followed by zeros for the penalty rows
+        """
+
+        b = self.weighted(data)
+        self.d[:self.nFidelity] = b if self.U is None else self.U.T.dot(b)
+
+        return self.d
+
+    def solve(self,alpha,data):
+
+        """
+        Returns x, the residual norm and the penalty norm ||Mx||
+
+        The residual norm is the one of the whole system, sqrt(||W(Ax - b)||**2 + alpha*||Mx||**2)
+        """
+
+        if self.method == "gram":
+            return self.solve_gram(alpha,data)
+
+        if self.method == "svd" and self.U is None:
+            self.compress()
+
+        if alpha != self.alpha:
+            self.C[self.nFidelity:] = np.sqrt(alpha) * self.M # Penalty term
+            self.alpha              = alpha
+
+        # residual from || Ax-b ||_2
+        x, residualNorm   = nnls(self.C, self.rhs(data))
+
+        # The residual of the compressed system misses the data outside U
+        if self.U is not None:
+            return (x,) + self.norms(alpha,x,self.weighted(data))
+
+        # Get the norm of the penalty term
+        penaltyNorm = np.linalg.norm(self.M.dot(x),2)
+
+        return x, residualNorm, penaltyNorm
+
+    def solve_gram(self,alpha,data):
+
+        b = self.weighted(data)
+
+        if self.data is None or not np.array_equal(self.data,data):
+            self.data, self.h = np.array(data), self.fidelity.T.dot(b)
+
+        if alpha != self.factorAlpha:
+            try:
+                self.R = cholesky(self.gram + alpha*self.penalty,check_finite=False)
+            # Not positive definite in floating point (tiny alpha), use the full system
+            except np.linalg.LinAlgError:
+                self.R = None
+            self.factorAlpha = alpha
+
+        if self.R is None:
+            self.method = "nnls"
+            try:
+                return self.solve(alpha,data)
+            finally:
+                self.method = "gram"
+
+        x, _ = nnls(self.R, solve_triangular(self.R,self.h,trans='T',check_finite=False))
+
+        return (x,) + self.norms(alpha,x,b)
+
+    def norms(self,alpha,x,b):
+
+        """
+        Residual and penalty norms of x, as nnls computes them
+        """
+
+        penaltyNorm  = np.linalg.norm(self.M.dot(x),2)
+        residualNorm = np.sqrt(np.linalg.norm(self.fidelity.dot(x) - b,2)**2 + alpha*penaltyNorm**2)
+
+        return residualNorm, penaltyNorm
+
+    def solve_path(self,alphaVec,data):
+
+        """
+        Solve every alpha of alphaVec in order, each one warm started (nnls_gram) from the solution
+        of the previous alpha, whose active set is nearly the same
+
+        Returns the solutions, residual norms and penalty norms, one row per alpha. An alpha whose solve
+        doesn't converge gets NaN (left out by find_Lcurve_corner) and the next one starts cold
+        """
+
+        b = self.weighted(data)
+
+        if not hasattr(self,'gram'):
+            self.gram    = self.fidelity.T.dot(self.fidelity)
+            self.penalty = self.M.T.dot(self.M)
+
+        h        = self.fidelity.T.dot(b)
+        x        = None
+        xs       = np.zeros((len(alphaVec),len(h)))
+        norms    = np.zeros((len(alphaVec),2))
+
+        for j, alpha in enumerate(alphaVec):
+            try:
+                x        = nnls_gram(self.gram + alpha*self.penalty,h,x)
+            except RuntimeError:
+                xs[j], norms[j], x = np.nan, np.nan, None
+                continue
+            xs[j]    = x
+            norms[j] = self.norms(alpha,x,b)
+
+        return xs, norms[:,0], norms[:,1]
+
 def tikhonov_Phillips_reg(kernel,alpha,data,W):
 
     """
@@ -116,41 +647,63 @@ def tikhonov_Phillips_reg(kernel,alpha,data,W):
     Quora answer (https://scicomp.stackexchange.com/questions/10671/tikhonov-regularization-in-the-non-negative-least-square-nnls-pythonscipy) 
     given by Dr. Brian Borchers (https://scicomp.stackexchange.com/users/2150/brian-borchers)
 
+    To solve many alphas or curves on the same kernel build a TikhonovSystem once instead
+
     """
 
-    W      = np.append(W,np.array([1e3,1e3,1e3])) # weight to force the initial and last values equal to 0, and the sum of contributions equal to 1
+    return TikhonovSystem(kernel,W).solve(alpha,data)
 
-    rowToForceInitialValue    = np.zeros(kernel.shape[1])
-    rowToForceInitialValue[0] = 1
-    rowToForceLastValue       = np.flip(rowToForceInitialValue)
+def kernel_matrix(time,s_space):
 
-    data   = np.sqrt(W)*np.append(data,np.array([1,0,0])) 
-    data   = data.reshape(-1, 1)
+    """
+    Kernel exp(-t/s) of the Tikhonov regularization, one row per time and one column per s
+    """
 
-    kernel = np.vstack([kernel,np.ones(kernel.shape[1]),rowToForceInitialValue,rowToForceLastValue])
-    kernel = np.sqrt(W)[:, None] * kernel # Fidelity term
-    
-    cols   = kernel.shape[1]
-    
-    M = np.zeros((cols,cols))
-    for i in range(1,M.shape[1]-1):
-        M[i,i-1] = -1
-        M[i,i]   =  2
-        M[i,i+1] = -1
-    
-    L      = np.sqrt(alpha) * M                     # Penalty term
-    C      = np.concatenate([kernel, L], axis=0)    
-    d      = np.concatenate([data, np.zeros(cols).reshape(-1, 1)])
-    
-    # residual from || Ax-b ||_2
-    x, residualNorm   = nnls(C, d.flatten())
+    return np.exp(-time[:, None]/s_space[None, :])
+
+def curve_systems(g1_autocorrelation,time,s_space,weights=None,method="nnls",svds=None):
+
+    """
+        Input -
 
-    # Get the norm of the penalty term
-    penaltyNorm = np.linalg.norm(M.dot(x),2)
+            g1 autocorrelation matrix n-points m-datasets
+            time vector of length n
+            s_space to create the kernel for the Thinkohonov regularization function
 
-    return x, residualNorm, penaltyNorm
+        Returns -
 
-def get_contributios_prior(g1_autocorrelation,time,s_space,betaPrior,alpha,weights=None):
+            One (TikhonovSystem, g1 up to the first NaN) pair per dataset. The kernel is built once and
+            datasets with the same length share one system when no weights are given
+            method is passed to TikhonovSystem. svds is a dict that keeps the kernel SVD of every
+            curve length (maxID) across calls on the same time grid and s_space, without weights
+
+    """
+
+    A       = kernel_matrix(time,s_space)
+    shared  = {}
+    systems = []
+
+    for i in range(g1_autocorrelation.shape[1]):
+
+        g1temp     = g1_autocorrelation[:,i]
+
+        try:
+            maxID      = np.min(np.argwhere(np.isnan(g1temp)))
+        except:
+            maxID      = len(g1temp)
+
+        if weights is None:
+            if maxID not in shared:
+                shared[maxID] = TikhonovSystem(A[:maxID,:],np.arange(maxID)*0 + 1,method,svds,maxID) # Equal weights
+            system = shared[maxID]
+        else:
+            system = TikhonovSystem(A[:maxID,:],weights[:maxID,i],method) # Custom weights
+
+        systems.append((system,g1temp[:maxID]))
+
+    return systems
+
+def get_contributios_prior(g1_autocorrelation,time,s_space,betaPrior,alpha,weights=None,method="nnls",batch=False,svds=None):
 
     """
         Input -
@@ -164,6 +717,9 @@ def get_contributios_prior(g1_autocorrelation,time,s_space,betaPrior,alpha,weigh
             
             The estimated contribution of each decay rate (length defined by the s_space vector)
 
+        With batch all the datasets are solved together (TikhonovBatch) instead of one by one with method
+        svds keeps the kernel SVDs of the "svd" method across calls, see curve_systems
+
     """
 
     nDatasets = g1_autocorrelation.shape[1]
@@ -176,42 +732,31 @@ def get_contributios_prior(g1_autocorrelation,time,s_space,betaPrior,alpha,weigh
         # No need to convert to list
         alphaList = alpha
 
-    s      = s_space.reshape((-1, 1))
-
-    sM, tM = np.meshgrid(s, time, indexing='xy')
-    A      = np.exp(-tM/sM)
+    if batch:
+        try:
+            xs, residuals, penaltyNorms = TikhonovBatch(g1_autocorrelation,time,s_space,weights).solve(alphaList)
+            return list(xs), list(residuals), list(penaltyNorms)
+        # If the fitting didn't work, fit the datasets one by one
+        except:
+            pass
 
+    systems       = curve_systems(g1_autocorrelation,time,s_space,weights,method,svds)
     contributions = []
     residuals     = []
     penaltyNorms  = []
 
-    for i in range(nDatasets):
-
-        g1temp     = g1_autocorrelation[:,i]
-
-        try:
-            maxID      = np.min(np.argwhere(np.isnan(g1temp)))
-        except:
-            maxID      = len(g1temp)
+    for i, (system, g1Filtered) in enumerate(systems):
 
         try:
 
-            if weights is  None:
-                weightsIdx = np.arange(maxID)*0 + 1 # Equal weights
-            else:
-                weightsIdx = weights[:maxID,i] # Custom weights
-
-            g1Filtered = g1temp[:maxID]
-            Afiltered  = A[:maxID,:]
-
-            cont, residual, penaltyNorm   = tikhonov_Phillips_reg(Afiltered,alphaList[i],g1Filtered,weightsIdx)
+            cont, residual, penaltyNorm   = system.solve(alphaList[i],g1Filtered)
 
         # If the fitting didn't work!
         except:
 
             cont        = [0]
-            residuals   = [0]
-            penaltyNorm = [0]
+            residual    = 0
+            penaltyNorm = 0
 
         contributions.append(np.array(cont))
         residuals.append(residual)
@@ -219,6 +764,126 @@ def get_contributios_prior(g1_autocorrelation,time,s_space,betaPrior,alpha,weigh
 
     return contributions, residuals, penaltyNorms
 
+def get_contributions_path(g1_autocorrelation,time,s_space,alphaVec,weights=None,method="nnls",warmStart=False,batch=False,svds=None):
+
+    """
+        Residual and penalty norms of get_contributios_prior for every alpha of alphaVec
+
+        The systems are assembled once for the whole sweep, only the penalty is rescaled per alpha
+        With warmStart the alphas are solved in order along the regularization path
+        (TikhonovSystem.solve_path) instead of one by one with method
+        With batch all the datasets are solved together at every alpha (TikhonovBatch.solve_path)
+        svds keeps the kernel SVDs of the "svd" method across calls (only used by the solves one by one)
+
+        Returns -
+
+            Residual norms and penalty norms, one row per alpha and one column per dataset,
+            NaN for the alphas whose fit didn't work (left out by find_Lcurve_corner)
+
+    """
+
+    if batch:
+        try:
+            _, residualNorms, penaltyNorms = TikhonovBatch(g1_autocorrelation,time,s_space,weights).solve_path(alphaVec,warmStart)
+            return residualNorms, penaltyNorms
+        # If the fitting didn't work, fit the datasets one by one
+        except:
+            pass
+
+    systems       = curve_systems(g1_autocorrelation,time,s_space,weights,method,svds)
+    residualNorms = np.full((len(alphaVec),len(systems)),np.nan)
+    penaltyNorms  = np.full((len(alphaVec),len(systems)),np.nan)
+
+    for i, (system, g1Filtered) in enumerate(systems):
+
+        if warmStart:
+            try:
+                _, residualNorms[:,i], penaltyNorms[:,i] = system.solve_path(alphaVec,g1Filtered)
+            # If the fitting didn't work!
+            except:
+                pass
+            continue
+
+        for j, alpha in enumerate(alphaVec):
+
+            try:
+                _, residualNorms[j,i], penaltyNorms[j,i] = system.solve(alpha,g1Filtered)
+            # If the fitting didn't work!
+            except:
+                pass
+
+    return residualNorms, penaltyNorms
+
+class TikhonovBatch:
+
+    """
+
+    The systems of get_contributios_prior for all the datasets at once, solved together with nnls_batch
+
+    All the datasets share one kernel (with the constraint rows of tikhonov_Phillips_reg): the times after
+    the first NaN of a curve are masked with a zero weight instead of cutting the kernel, so a dataset only
+    has its own row weights and A'Wb.
+
+    """
+
+    def __init__(self,g1_autocorrelation,time,s_space,weights=None):
+
+        nTimes, nDatasets = g1_autocorrelation.shape
+
+        W = np.ones((nTimes,nDatasets)) if weights is None else np.array(weights[:nTimes],dtype=float)
+        W[np.cumsum(np.isnan(g1_autocorrelation),axis=0) > 0] = 0 # Mask every curve from its first NaN on
+
+        self.kernel, constraintWeights = constrained_kernel(kernel_matrix(time,s_space),W[:,0])
+
+        self.weights = np.hstack([W.T,np.tile(constraintWeights[nTimes:],(nDatasets,1))]) # One row per dataset
+        self.data    = np.hstack([np.where(W.T > 0,g1_autocorrelation.T,0),np.tile([1,0,0],(nDatasets,1))])
+        self.M       = second_difference_matrix(len(s_space))
+        self.penalty = self.M.T.dot(self.M)
+        self.H       = (self.weights*self.data).dot(self.kernel)
+        self.gram    = np.matmul(self.kernel.T*self.weights[:,None,:],self.kernel)
+
+    def solve(self,alphas,X0=None):
+
+        """
+        Solutions of every dataset (one row each) for one alpha per dataset (or the same alpha for all),
+        their residual norms and penalty norms
+        """
+
+        X = nnls_batch(self.kernel,self.weights,self.penalty,alphas,self.H,X0,self.gram)
+
+        return (X,) + self.norms(alphas,X)
+
+    def norms(self,alphas,X):
+
+        """
+        Residual and penalty norms of the solutions X, as TikhonovSystem.norms
+        """
+
+        penaltyNorms  = np.linalg.norm(X.dot(self.M.T),axis=1)
+        residualNorms = np.sqrt(np.sum(self.weights*(X.dot(self.kernel.T) - self.data)**2,axis=1) + np.asarray(alphas)*penaltyNorms**2)
+
+        return residualNorms, penaltyNorms
+
+    def solve_path(self,alphaVec,warmStart=True):
+
+        """
+        solve for every alpha of alphaVec (the same for all the datasets), with warmStart every alpha
+        starts from the solutions of the previous one (as TikhonovSystem.solve_path)
+
+        Returns the solutions (n alpha x m x n s), the residual norms and the penalty norms (n alpha x m)
+        """
+
+        X             = None
+        xs            = np.zeros((len(alphaVec),) + self.H.shape)
+        residualNorms = np.zeros((len(alphaVec),len(self.H)))
+        penaltyNorms  = np.zeros((len(alphaVec),len(self.H)))
+
+        for j, alpha in enumerate(alphaVec):
+            xs[j], residualNorms[j], penaltyNorms[j] = self.solve(alpha,X if warmStart else None)
+            X = xs[j]
+
+        return xs, residualNorms, penaltyNorms
+
 def g2_finite_aproximation(decay_rates,times,beta,contributions):
               
     """
@@ -260,13 +925,19 @@ def find_Lcurve_corner(residualsNorm,contributionsNorm):
 
     Input - the norm vector of the residuals and the norm vector of the contributions
             i.e., the norm of the fidelity term and the norm of the penalty term
+            The points with a NaN (or non positive) norm, whose fit didn't work, are left out
 
     Returns the position of the corner of the curve log(contributionsNorm) vs log(residualsNorm) 
     """
 
+    residualsNorm, contributionsNorm = np.asarray(residualsNorm,dtype=float), np.asarray(contributionsNorm,dtype=float)
+    valid = np.flatnonzero((residualsNorm > 0) & (contributionsNorm > 0)) # False for NaN too
+    if len(valid) < 5:
+        return None
+
     # Convert to log
-    x = np.log(residualsNorm)
-    y = np.log(contributionsNorm)
+    x = np.log(residualsNorm[valid])
+    y = np.log(contributionsNorm[valid])
 
     # Normalise to avoid floating point errors - This doesn't change the shape of the curve
     x = (x - np.min(x)) / (np.max(x)-np.min(x)) * 100
@@ -280,12 +951,12 @@ def find_Lcurve_corner(residualsNorm,contributionsNorm):
     C = (x[nPoints-1],y[nPoints-1]) # Last point of the curve
     for i in range(nPoints-4):
         B = (x[i],y[i])
-        d3 = spatial.distance.cdist([B],[C])[0]
+        d3 = spatial.distance.cdist([B],[C])[0,0]
 
         for ii in range(i+2,nPoints-2):
             A  = (x[ii],y[ii])   
-            d1 = spatial.distance.cdist([B],[A])[0]
-            d2 = spatial.distance.cdist([A],[C])[0]
+            d1 = spatial.distance.cdist([B],[A])[0,0]
+            d2 = spatial.distance.cdist([A],[C])[0,0]
 
             area = (B[0] - A[0])*(A[1]-C[1]) - (A[0] - C[0])*(B[1]-A[1])
             
@@ -299,7 +970,7 @@ def find_Lcurve_corner(residualsNorm,contributionsNorm):
     try:
 
         selIdx2    = poi2[np.argmin(angles)]
-        return selIdx2 
+        return int(valid[selIdx2])
 
     except:
 
@@ -23,6 +23,25 @@ def readWyatFile(file):
 
     df = pd.read_csv(file, sep=',',encoding=' latin-1')
 
+    return readWyatDataFrame(df)
+
+def readWyatArrays(time, autocorrelation, sampleNames):
+
+    """
+
+    Same as readWyatFile for data already in memory: time in microseconds and
+    one autocorrelation column per sample name
+
+    """
+
+    columns = {"Time(microseconds)": time}
+    for ind, name in enumerate(sampleNames):
+        columns[name] = autocorrelation[:, ind]
+
+    return readWyatDataFrame(pd.DataFrame(columns))
+
+def readWyatDataFrame(df):
+
     df = df.sort_values(by=[df.columns[0]], ascending=True)
 
     # Delete the first point 
@@ -0,0 +1,200 @@
+"""
+Compact binary store for raw acquisitions (replaces the per-sample data_output.csv)
+
+File layout:
+    header - magic, format version and number of readings per batch (RAW_HEADER_DTYPE)
+    chunks - one fixed size record per batch, appended as the batches arrive (raw_record_dtype):
+                start   - time of the first reading in microseconds
+                step    - average time between readings in microseconds
+                temp    - temperature in Celsius (one value per batch)
+                samples - the readings as uint16
+
+Sample i of a batch was taken at int(start + i*step), the same time stamps the csv had.
+Because every record has the same size, readers can memory-map the whole file as a record array.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+RAW_MAGIC        = b'uDLS'
+RAW_VERSION      = 1
+RAW_HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', '<u2'), ('subset_length', '<u2'), ('reserved', '<u8')])
+CSV_HEADER       = ["Time(microseconds)", "DLS Value", "Temperature(C)"]
+
+def raw_record_dtype(subset_length):
+
+    return np.dtype([
+        ('start', '<i8'),
+        ('step', '<f8'),
+        ('temp', '<f4'),
+        ('samples', '<u2', (subset_length,)),
+    ])
+
+class RawDataWriter:
+
+    """
+    Append-only writer for the raw store, one record per batch
+    """
+
+    def __init__(self, file_name, subset_length):
+
+        self.dtype  = raw_record_dtype(subset_length)
+        self.record = np.zeros(1, dtype=self.dtype) # Reused for every batch
+        self.file   = open(file_name, mode='wb')
+
+        header = np.array([(RAW_MAGIC, RAW_VERSION, subset_length, 0)], dtype=RAW_HEADER_DTYPE)
+        self.file.write(header.tobytes())
+        self.file.flush()
+
+    def write_batch(self, start, step, temp_c, dls_values):
+
+        """
+        start and step in microseconds, dls_values of length subset_length
+        """
+
+        self.record['start']   = start
+        self.record['step']    = step
+        self.record['temp']    = temp_c
+        self.record['samples'] = dls_values
+
+        self.file.write(self.record.tobytes())
+        self.file.flush() # Keep the file readable while the acquisition is running
+
+        return None
+
+    def write_batches(self, starts, steps, temps_c, readings):
+
+        """
+        Append many batches at once, readings of shape (n batches, subset_length)
+        """
+
+        records            = np.zeros(len(readings), dtype=self.dtype)
+        records['start']   = starts
+        records['step']    = steps
+        records['temp']    = temps_c
+        records['samples'] = readings
+
+        self.file.write(records.tobytes())
+        self.file.flush()
+
+        return None
+
+    def close(self):
+
+        self.file.close()
+
+        return None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+def open_raw(file_name):
+
+    """
+    Memory-map a raw store
+
+    Returns a read-only record array with one row per complete batch
+    (a batch that is still being written is left out)
+    """
+
+    header = np.fromfile(file_name, dtype=RAW_HEADER_DTYPE, count=1)
+
+    if len(header) == 0 or header['magic'][0] != RAW_MAGIC:
+        raise ValueError(f"{file_name} is not a raw DLS file")
+
+    dtype    = raw_record_dtype(int(header['subset_length'][0]))
+    nRecords = (os.path.getsize(file_name) - RAW_HEADER_DTYPE.itemsize) // dtype.itemsize
+
+    if nRecords == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(file_name, dtype=dtype, mode='r', offset=RAW_HEADER_DTYPE.itemsize, shape=(nRecords,))
+
+def record_times(records):
+
+    """
+    Time stamps (microseconds) of every reading, shape (n batches, subset_length)
+    """
+
+    steps = np.arange(records.dtype['samples'].shape[0])
+
+    return (steps * records['step'][:, None] + records['start'][:, None]).astype(np.int64)
+
+def load_raw(file_name):
+
+    """
+    Load a raw acquisition, either a raw store or a csv with the CSV_HEADER columns
+
+    Returns time (microseconds), DLS values and temperature (C), one element per reading
+    """
+
+    if file_name.endswith('.csv'):
+
+        df = pd.read_csv(file_name)
+
+        return np.array(df[CSV_HEADER[0]]), np.array(df[CSV_HEADER[1]]), np.array(df[CSV_HEADER[2]])
+
+    records     = open_raw(file_name)
+    nReadings   = records.dtype['samples'].shape[0]
+
+    time        = record_times(records).reshape(-1)
+    dls_values  = records['samples'].reshape(-1)
+    temperature = np.repeat(records['temp'], nReadings)
+
+    return time, dls_values, temperature
+
+def iter_raw(file_name, readings_per_chunk=800000):
+
+    """
+    load_raw chunk by chunk, so a long run never has to fit in memory
+
+    Yields time (microseconds), DLS values and temperature (C) of about readings_per_chunk readings at a time
+    (whole batches for a raw store)
+    """
+
+    if file_name.endswith('.csv'):
+
+        for df in pd.read_csv(file_name, chunksize=readings_per_chunk):
+            yield np.array(df[CSV_HEADER[0]]), np.array(df[CSV_HEADER[1]]), np.array(df[CSV_HEADER[2]])
+
+        return
+
+    records   = open_raw(file_name)
+    nReadings = records.dtype['samples'].shape[0]
+    batches   = max(1, readings_per_chunk // nReadings)
+
+    for first in range(0, len(records), batches):
+
+        chunk = records[first:first + batches]
+
+        yield record_times(chunk).reshape(-1), chunk['samples'].reshape(-1), np.repeat(chunk['temp'], nReadings)
+
+def export_csv(file_name, csv_file_name, batches_per_chunk=1000):
+
+    """
+    Export a raw store to the csv format the acquisition used to write
+    """
+
+    records = open_raw(file_name)
+
+    with open(csv_file_name, mode='w', newline='') as file:
+
+        file.write(",".join(CSV_HEADER) + "\n")
+
+        for first in range(0, len(records), batches_per_chunk):
+
+            chunk = records[first:first + batches_per_chunk]
+            rows  = np.column_stack((
+                record_times(chunk).reshape(-1),
+                chunk['samples'].reshape(-1),
+                np.repeat(chunk['temp'], chunk.dtype['samples'].shape[0])))
+
+            np.savetxt(file, rows, fmt=('%d', '%d', '%g'), delimiter=',')
+
+    return None
@@ -0,0 +1,161 @@
+"""
+Synthetic DLS intensity traces with a known size distribution, for benchmarks and accuracy checks
+
+The scattered field of each size class is a complex Gaussian process whose autocorrelation decays
+as exp(-gamma*t), gamma = D*q**2. The field of all classes together is generated by filtering complex
+white noise with the summed (sampled) Lorentzian spectrum, one batched FFT for many batches at once.
+The detector sees |E|**2 plus a flat background that sets the intercept beta, so g2 = 1 + beta*g1**2.
+
+Batches are generated independently, like the device, which sends one batch and then spends far
+longer than a decay time transmitting it.
+"""
+
+import argparse
+import time
+import numpy as np
+from scipy import fft
+
+from data_processing.helpers import get_q, diffusion_from_hydrodynamic_radius, VISCOSITY_VALUES
+from data_processing.raw_data import RawDataWriter
+
+SUBSET_LENGTH = 800
+ADC_ELAPSED   = 14110 # Microseconds the firmware takes for one batch of readings
+ADC_MAX       = 1023
+
+def monodisperse(diameter):
+
+    """
+    Returns diameters (nm) and intensity weighted contributions
+    """
+
+    return np.array([diameter], dtype=float), np.array([1.0])
+
+def bimodal(diameter1, diameter2, fraction1=0.5):
+
+    """
+    fraction1 is the intensity weighted contribution of the first population
+    """
+
+    return np.array([diameter1, diameter2], dtype=float), np.array([fraction1, 1 - fraction1])
+
+def lognormal(median_diameter, sigma=0.2, n=40):
+
+    """
+    Polydisperse sample, sigma is the standard deviation of log(diameter)
+    """
+
+    logD    = np.log(median_diameter) + np.linspace(-3 * sigma, 3 * sigma, n)
+    weights = np.exp(-0.5 * ((logD - np.log(median_diameter)) / sigma) ** 2)
+
+    return np.exp(logD), weights / weights.sum()
+
+def decay_rates(diameters, solvent="Water", temperature=298, lambda0=635, scatteringAngle=np.pi / 2, refractiveIndex=1.33):
+
+    """
+    Decay rates (1/s) of g1 for particles of the given diameters (nm) in one of VISCOSITY_VALUES
+    """
+
+    viscosity = VISCOSITY_VALUES[solvent] / 1e3 # mPa·s to pascal-second
+    q         = get_q(lambda0, refractiveIndex, scatteringAngle)
+    D         = diffusion_from_hydrodynamic_radius(np.asarray(diameters) / 2 / 1e9, temperature, viscosity)
+
+    return D * q ** 2
+
+def field_spectrum(gammas, weights, dt, n):
+
+    """
+    Power spectrum of the sampled field, the sum of one AR(1) (sampled Lorentzian) spectrum per size class
+    """
+
+    a     = np.exp(-np.asarray(gammas) * dt)[:, None]
+    omega = 2 * np.pi * np.fft.fftfreq(n)[None, :]
+
+    spectrum = (1 - a ** 2) / np.abs(1 - a * np.exp(-1j * omega)) ** 2
+
+    return (np.asarray(weights)[:, None] * spectrum).sum(axis=0)
+
+def intensity_batches(nBatches, gammas, weights, dt, subset_length=SUBSET_LENGTH,
+    beta=0.5, mean_counts=150, adc_noise=2.0, chunk=1024, seed=None):
+
+    """
+    Generate nBatches x subset_length ADC readings
+
+    gammas and weights  - decay rates (1/s) and intensity weighted contributions
+    dt                  - time between readings in seconds
+    beta                - intercept of g2 - 1
+    mean_counts         - mean detector level in ADC counts, low enough that speckle peaks rarely clip at ADC_MAX
+    adc_noise           - standard deviation of the (uncorrelated) detector noise in counts
+    """
+
+    rng     = np.random.default_rng(seed)
+    weights = np.asarray(weights, dtype=float) / np.sum(weights)
+
+    # Generate twice the batch length and keep the first half, so the circular FFT filter doesn't wrap
+    n      = 2 * subset_length
+    filt   = np.sqrt(field_spectrum(gammas, weights, dt, n)).astype(np.float32)
+
+    background = 1 / np.sqrt(beta) - 1 # Flat intensity that brings the speckle contrast down to beta
+    readings   = np.empty((nBatches, subset_length), dtype=np.uint16)
+
+    for first in range(0, nBatches, chunk):
+
+        m     = min(chunk, nBatches - first)
+        noise = np.empty((m, n), dtype=np.complex64)
+        noise.real, noise.imag = rng.standard_normal((2, m, n), dtype=np.float32) / np.sqrt(2)
+        field = fft.ifft(fft.fft(noise, axis=1, workers=-1) * filt, axis=1, workers=-1)[:, :subset_length]
+
+        intensity = (field.real ** 2 + field.imag ** 2 + background) / (1 + background)
+        counts    = mean_counts * intensity + rng.normal(0, adc_noise, intensity.shape)
+
+        readings[first:first + m] = np.clip(np.rint(counts), 0, ADC_MAX)
+
+    return readings
+
+def synthetic_batches(nBatches, diameters, weights, solvent="Water", temperature=298,
+    elapsed=ADC_ELAPSED, subset_length=SUBSET_LENGTH, **kwargs):
+
+    """
+    Batches as the firmware sends them: readings (n batches x subset_length), elapsed time per batch
+    (microseconds) and temperature per batch (C). kwargs are passed to intensity_batches
+    """
+
+    gammas   = decay_rates(diameters, solvent, temperature)
+    readings = intensity_batches(nBatches, gammas, weights, elapsed / subset_length / 1e6, subset_length, **kwargs)
+
+    return readings, np.full(nBatches, elapsed, dtype=np.int64), np.full(nBatches, temperature - 273.15)
+
+def write_synthetic_run(file_name, nBatches, diameters, weights, **kwargs):
+
+    """
+    Write a synthetic acquisition to a raw store, with the time stamps the acquisition would give it
+    """
+
+    readings, elapsed, temperature = synthetic_batches(nBatches, diameters, weights, **kwargs)
+    starts = np.cumsum(elapsed) - elapsed
+
+    with RawDataWriter(file_name, readings.shape[1]) as writer:
+        writer.write_batches(starts, elapsed / readings.shape[1], temperature, readings)
+
+    return None
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Write a synthetic raw DLS acquisition")
+    parser.add_argument("file_name", help="output raw store, e.g. synthetic_output.dls")
+    parser.add_argument("--batches", type=int, default=10000)
+    parser.add_argument("--diameter", type=float, nargs="+", default=[200], help="one value: monodisperse, two: bimodal (50/50)")
+    parser.add_argument("--sigma", type=float, default=None, help="lognormal width, uses the first diameter as the median")
+    parser.add_argument("--solvent", default="Water", choices=list(VISCOSITY_VALUES))
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.sigma is not None:
+        diameters, weights = lognormal(args.diameter[0], args.sigma)
+    elif len(args.diameter) == 2:
+        diameters, weights = bimodal(*args.diameter)
+    else:
+        diameters, weights = monodisperse(args.diameter[0])
+
+    start = time.time()
+    write_synthetic_run(args.file_name, args.batches, diameters, weights, solvent=args.solvent, seed=args.seed)
+    print(f"{args.batches} batches written to {args.file_name} in {time.time() - start:.1f} s")
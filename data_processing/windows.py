@@ -0,0 +1,134 @@
+"""
+Out-of-core analysis of long recordings: the run is cut into windows of consecutive segments and every
+window is fitted on its own, reading the file chunk by chunk (framing.iter_segments)
+
+Memory stays bounded by one chunk of readings plus the lag sums (correlation) or peaks (peaks) of the
+current window, whatever the length of the run. One row per window, with its summary statistics and the
+diameter of every curve, is appended to the output csv as soon as the window is fitted, so a multi-hour
+recording can be followed (or interrupted) while it is being analyzed.
+"""
+
+import argparse
+import csv
+import numpy as np
+
+from data_processing.framing import iter_segments, CHUNK_SEGMENTS
+from data_processing.correlator import StreamingCorrelator
+from data_processing.csv_conversion import StreamingPeaks, NUM_SETS, set_names
+from data_processing.demo_script import analyze_correlation, analyze_peaks, results_tables
+
+WINDOW_SEGMENTS = 4096 # Segments per window, about 10 minutes of acquisition
+
+class WindowStats:
+
+    """
+    Running count, mean and standard deviation of the readings of a window
+    """
+
+    def __init__(self):
+
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, segments):
+
+        values = np.asarray(segments, dtype=np.float64)
+        self.count   += values.size
+        self.total   += values.sum()
+        self.squares += np.square(values).sum()
+        self.min      = values.min() if self.min is None else min(self.min, values.min())
+        self.max      = values.max() if self.max is None else max(self.max, values.max())
+
+        return None
+
+    def summary(self):
+
+        mean = self.total / self.count
+
+        return [mean, np.sqrt(max(self.squares / self.count - mean ** 2, 0.0)), self.min, self.max]
+
+def window_diameters(stream, method, n_curves):
+
+    """
+    Fitted diameter (nm) of every curve of a window in the order of set_names(n_curves), None for curves
+    without a result (rejected as outliers, or missing from a window with fewer blocks than curves)
+    """
+
+    snapshot = stream.snapshot(n_curves)
+    if snapshot is None:
+        return [None] * n_curves
+
+    d = analyze_correlation(*snapshot) if method == "correlation" else analyze_peaks(*snapshot)
+    df_results, _ = results_tables(d)
+    # results_tables numbers the curves that were fitted, which are the kept ones of d.sampleInfo
+    diameters = {name: df_results[f'Diameter {i + 1} (nm)'].iloc[0] for i, name in enumerate(d.sampleInfoRelevant.conditions)}
+
+    return [diameters.get(name) for name in set_names(n_curves)]
+
+def analyze_windows(file_name, output, method="correlation", window_segments=WINDOW_SEGMENTS,
+    n_curves=NUM_SETS, segment_length=None, chunk_segments=CHUNK_SEGMENTS):
+
+    """
+    Fit every window of window_segments segments of a run (the last one may be shorter), method is
+    "correlation" (multi-tau g2) or "peaks". Rows are appended to output as the windows are fitted.
+
+    Returns the number of windows
+    """
+
+    header = ["Window", "First segment", "Segments", "Mean intensity", "Intensity std", "Min intensity",
+        "Max intensity"] + [f"Diameter {name} (nm)" for name in set_names(n_curves)]
+    stream_type = StreamingCorrelator if method == "correlation" else StreamingPeaks
+
+    with open(output, mode='w', newline='') as file:
+
+        writer = csv.writer(file)
+        writer.writerow(header)
+
+        window, first = 0, 0
+        stream, stats = None, WindowStats()
+
+        def write_window():
+            writer.writerow([window, first, stream.nBatches] + stats.summary() + window_diameters(stream, method, n_curves))
+            file.flush()
+
+        for segments, framing in iter_segments(file_name, segment_length, chunk_segments):
+
+            step, position = framing.dt * 1e6, 0
+            while position < len(segments):
+
+                if stream is None:
+                    stream = stream_type(framing.segment_length)
+
+                # Up to the end of the current window
+                part = segments[position:position + window_segments - stream.nBatches]
+                stats.add(part)
+                for row in part:
+                    stream.add_batch(0, step, 0, row)
+                position += len(part)
+
+                if stream.nBatches == window_segments:
+                    write_window()
+                    window, first = window + 1, first + window_segments
+                    stream, stats = None, WindowStats()
+
+        if stream is not None and stream.nBatches:
+            write_window()
+            window += 1
+
+    return window
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fit a long recording window by window with bounded memory")
+    parser.add_argument("file_name", help="raw store (data_output.dls) or csv")
+    parser.add_argument("output", help="csv with one row per window")
+    parser.add_argument("--method", choices=["correlation", "peaks"], default="correlation")
+    parser.add_argument("--window", type=int, default=WINDOW_SEGMENTS, help="segments per window")
+    parser.add_argument("--curves", type=int, default=NUM_SETS)
+    parser.add_argument("--segment-length", type=int, default=None)
+    args = parser.parse_args()
+
+    analyze_windows(args.file_name, args.output, args.method, args.window, args.curves, args.segment_length)
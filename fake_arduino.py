@@ -0,0 +1,181 @@
+"""
+Fake µicroDLS: emulate upload_DLS.ino on a pseudo-terminal, so the acquisition can be run,
+tested and benchmarked without the device (Linux / macOS)
+
+    python fake_arduino.py --replay data_output.dls --speed 10
+    python fake_arduino.py --synthetic --diameter 200 --speed 0
+
+The emulator links its port to FAKE_PORT_LINK, where GetArdunioData looks when no Arduino is plugged in.
+Run several with --link /tmp/ttyMicroDLS2, /tmp/ttyMicroDLS3, ... to emulate several devices.
+It answers the same one byte commands as the firmware ('H'/'L' laser, 'B'/'T' binary or text frames)
+and sends LID_OPEN lines once the simulated lid is opened.
+"""
+
+import argparse
+import os
+import pty
+import select
+import time
+import tty
+import numpy as np
+
+from connect_arduino import BAUD_RATE, SUBSET_LENGTH, FRAME_DTYPE, FRAME_SYNC, LID_OPEN, FAKE_PORT_LINK, crc16
+from data_processing.raw_data import load_raw
+from data_processing.synthetic_signal import synthetic_batches, monodisperse, ADC_ELAPSED
+
+def replay_batches(file_name, subset_length=SUBSET_LENGTH):
+
+    """
+    Cut a recorded run (raw store or csv) back into the batches the firmware sent
+
+    Returns readings (n batches x subset_length), elapsed time per batch (microseconds) and temperature per batch
+    """
+
+    time_series, dls_values, temperature = load_raw(file_name)
+
+    nBatches    = len(dls_values) // subset_length
+    readings    = np.asarray(dls_values[:nBatches * subset_length]).reshape(nBatches, subset_length)
+    starts      = np.asarray(time_series[:nBatches * subset_length:subset_length])
+    temperature = np.asarray(temperature[:nBatches * subset_length:subset_length])
+
+    # The batch start times are the running sum of the elapsed times, the last batch reuses the previous one
+    elapsed = np.diff(starts, append=starts[-1] + (starts[-1] - starts[-2] if nBatches > 1 else ADC_ELAPSED))
+
+    return readings.astype(np.uint16), elapsed.astype(np.int64), temperature
+
+def encode_text(dls_values, elapsed, temp_c):
+
+    # Same as the Serial.print loop in the firmware
+    return (",".join(map(str, dls_values.tolist())) + f",{int(elapsed)},{temp_c:g}\r\n").encode()
+
+def encode_frame(seq, dls_values, elapsed, temp_c):
+
+    frame = np.zeros(1, dtype=FRAME_DTYPE)
+    frame['sync']    = int.from_bytes(FRAME_SYNC, 'little')
+    frame['seq']     = seq & 0xFFFF
+    frame['samples'] = dls_values
+    frame['elapsed'] = elapsed
+    frame['temp']    = round(temp_c * 100)
+
+    frame = frame.tobytes()
+    crc   = crc16(frame[len(FRAME_SYNC):-2])
+
+    return frame[:-2] + crc.to_bytes(2, 'little')
+
+class FakeArduino:
+
+    """
+    Serve batches on a pty, looping over them until stopped
+
+    speed - 1 paces the batches like the device (ADC time + transmit time at baud), N is N times faster, 0 is unpaced
+    """
+
+    def __init__(self, readings, elapsed, temperature, speed=1.0, baud=BAUD_RATE, lid_open_after=None, link=FAKE_PORT_LINK):
+
+        self.readings, self.elapsed, self.temperature = readings, elapsed, temperature
+        self.speed          = speed
+        self.baud           = baud
+        self.lid_open_after = lid_open_after
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False) # A full pty buffer loses data, like the real UART
+        self.port = os.ttyname(self.slave)
+
+        self.link = link
+        if self.link is not None:
+            if os.path.lexists(self.link):
+                os.remove(self.link)
+            os.symlink(self.port, self.link)
+
+        self.binary       = False
+        self.laser_on     = False
+        self.seq          = 0
+        self.bytes_sent   = 0
+        self.bytes_lost   = 0
+
+    def handle_commands(self):
+
+        while select.select([self.master], [], [], 0)[0]:
+            for command in os.read(self.master, 64):
+                command = chr(command)
+                if command == 'B':
+                    self.binary = True
+                elif command == 'T':
+                    self.binary = False
+                else:
+                    self.laser_on = command == 'H'
+
+    def send(self, payload):
+
+        try:
+            sent = os.write(self.master, payload)
+        except BlockingIOError:
+            sent = 0
+
+        self.bytes_sent += sent
+        self.bytes_lost += len(payload) - sent
+
+    def serve(self, duration=None):
+
+        start     = time.time()
+        next_time = start
+        batch     = 0
+
+        while duration is None or time.time() - start < duration:
+
+            self.handle_commands()
+
+            if self.lid_open_after is not None and time.time() - start > self.lid_open_after:
+                payload, period = LID_OPEN, 0.01
+            else:
+                i       = batch % len(self.readings)
+                elapsed = self.elapsed[i]
+                if self.binary:
+                    payload = encode_frame(self.seq, self.readings[i], elapsed, self.temperature[i])
+                else:
+                    payload = encode_text(self.readings[i], elapsed, self.temperature[i])
+                # The firmware reads the ADC, then blocks until the batch is transmitted
+                period = elapsed / 1e6 + len(payload) * 10 / self.baud
+                self.seq += 1
+                batch    += 1
+
+            if self.speed > 0:
+                next_time += period / self.speed
+                time.sleep(max(0, next_time - time.time()))
+
+            self.send(payload)
+
+        return None
+
+    def close(self):
+
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+        os.close(self.master)
+        os.close(self.slave)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Emulate the µicroDLS firmware on a pseudo-terminal")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--replay", help="recorded run to replay (data_output.dls or csv)")
+    source.add_argument("--synthetic", action="store_true", help="send a synthetic stream (see data_processing.synthetic_signal)")
+    parser.add_argument("--diameter", type=float, default=200, help="particle diameter (nm) of the synthetic stream")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = real time, N = N times faster, 0 = as fast as possible")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run (default: until interrupted)")
+    parser.add_argument("--lid-open-after", type=float, default=None, help="open the lid after this many seconds")
+    parser.add_argument("--link", default=FAKE_PORT_LINK, help="port link, use FAKE_PORT_LINK + a suffix to emulate several devices")
+    args = parser.parse_args()
+
+    batches = replay_batches(args.replay) if args.replay else synthetic_batches(1000, *monodisperse(args.diameter))
+    device  = FakeArduino(*batches, speed=args.speed, lid_open_after=args.lid_open_after, link=args.link)
+    print(f"Fake µicroDLS on {device.port} (linked from {device.link})")
+
+    try:
+        device.serve(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Sent {device.bytes_sent} bytes, lost {device.bytes_lost} bytes to a full buffer")
+        device.close()
@@ -0,0 +1,215 @@
+"""
+Acquisition telemetry: counters, rates and histograms collected while the acquisition runs
+
+They tell where a slow or lossy run comes from:
+    device   - ADC time per batch as reported by the firmware (adc_elapsed_us)
+    USB link - bytes/s and frames/s at the reader, time between frames, frames missing from the sequence
+    host     - parse latency, decoder queue depth, frames dropped on a full queue
+
+A snapshot (a plain dict) is shown live in the app and saved next to the raw store as json.
+"""
+
+import bisect
+import collections
+import json
+import os
+import time
+import numpy as np
+
+RATE_WINDOW = 5.0 # Seconds the current byte and frame rates are averaged over
+
+class Histogram:
+
+    """
+    Fixed bins histogram with count, mean, min and max, cheap enough to update for every frame
+
+    Values below the first edge go in the first bin, values above the last edge in the last bin.
+    """
+
+    def __init__(self, edges):
+
+        self.edges  = list(edges)
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count  = 0
+        self.total  = 0.0
+        self.min    = None
+        self.max    = None
+
+    def add(self, value):
+
+        self.counts[bisect.bisect_right(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min    = value if self.min is None else min(self.min, value)
+        self.max    = value if self.max is None else max(self.max, value)
+
+        return None
+
+    def quantile(self, q):
+
+        """
+        Upper edge of the bin holding the q-th quantile (the max for the open last bin)
+        """
+
+        if self.count == 0:
+            return None
+
+        index = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+
+        return self.edges[index] if index < len(self.edges) else self.max
+
+    def summary(self):
+
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'edges': self.edges,
+            'counts': list(self.counts),
+        }
+
+class RateMeter:
+
+    """
+    Rate of a growing total over the last window seconds
+    """
+
+    def __init__(self, window=RATE_WINDOW):
+
+        self.window  = window
+        self.samples = collections.deque()
+
+    def sample(self, total, now):
+
+        self.samples.append((now, total))
+        while now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+        return None
+
+    def rate(self):
+
+        if len(self.samples) < 2:
+            return 0.0
+
+        (first_time, first_total), (last_time, last_total) = self.samples[0], self.samples[-1]
+
+        return (last_total - first_total) / (last_time - first_time) if last_time > first_time else 0.0
+
+class AcquisitionTelemetry:
+
+    """
+    Histograms and rates of one acquisition, updated by the pipeline stages
+
+    The reader stage samples the rates, the queue depth and the time between frames,
+    the decoder stage the firmware ADC time and the parse latency. Each histogram has one writer.
+    """
+
+    def __init__(self, queue_size):
+
+        self.start      = time.perf_counter()
+        self.last_frame = None
+        self.last_rate  = None
+
+        self.byte_rate  = RateMeter()
+        self.frame_rate = RateMeter()
+
+        # Log spaced bins for times, powers of two for the queue
+        self.histograms = {
+            'adc_elapsed_us': Histogram(np.logspace(3, 6, 31).tolist()),
+            'parse_latency_us': Histogram(np.logspace(0, 5, 26).tolist()),
+            'frame_interval_ms': Histogram(np.logspace(-1, 4, 26).tolist()),
+            'queue_depth': Histogram([0] + [2 ** i for i in range(int(np.log2(queue_size)) + 1)]),
+        }
+
+    def frame_read(self, queue_depth, now):
+
+        if self.last_frame is not None:
+            self.histograms['frame_interval_ms'].add((now - self.last_frame) * 1e3)
+        self.last_frame = now
+        self.histograms['queue_depth'].add(queue_depth)
+
+        return None
+
+    def frame_decoded(self, elapsed_time_microseconds, parse_seconds):
+
+        self.histograms['adc_elapsed_us'].add(elapsed_time_microseconds)
+        self.histograms['parse_latency_us'].add(parse_seconds * 1e6)
+
+        return None
+
+    def sample_rates(self, bytes_read, frames_read, now, interval=0.5):
+
+        """
+        Called from the read loop, records the totals at most every interval seconds
+        """
+
+        if self.last_rate is None or now - self.last_rate >= interval:
+            self.byte_rate.sample(bytes_read, now)
+            self.frame_rate.sample(frames_read, now)
+            self.last_rate = now
+
+        return None
+
+    def snapshot(self, counters, bytes_read):
+
+        """
+        Counters (AcquisitionPipeline.counters), totals, current rates and histogram summaries as a json-ready dict
+        """
+
+        duration = time.perf_counter() - self.start
+
+        return {
+            'duration_s': duration,
+            'bytes_read': bytes_read,
+            'bytes_per_s': self.byte_rate.rate(),
+            'frames_per_s': self.frame_rate.rate(),
+            'mean_bytes_per_s': bytes_read / duration if duration > 0 else 0.0,
+            'counters': dict(counters),
+            'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+        }
+
+def telemetry_filename(raw_filename):
+
+    """
+    data_output.dls -> data_output.telemetry.json
+    """
+
+    return os.path.splitext(raw_filename)[0] + '.telemetry.json'
+
+def save_telemetry(snapshot, raw_filename, **metadata):
+
+    """
+    Save a snapshot next to the raw store, with any metadata (port, binary, error, ...)
+    """
+
+    file_name = telemetry_filename(raw_filename)
+
+    with open(file_name, mode='w') as file:
+        json.dump(dict(snapshot, raw_file=raw_filename, **metadata), file, indent=2)
+
+    return file_name
+
+def format_telemetry(snapshot):
+
+    """
+    One line summary for the GUI
+    """
+
+    if not snapshot:
+        return ""
+
+    counters   = snapshot['counters']
+    histograms = snapshot['histograms']
+
+    def mean(name, scale=1):
+        value = histograms[name]['mean']
+        return '-' if value is None else f"{value * scale:.3g}"
+
+    return (f"{snapshot['bytes_per_s'] / 1e3:.1f} kB/s   {snapshot['frames_per_s']:.1f} frames/s   "
+            f"malformed {counters['malformed']}   dropped {counters['dropped']}   missed {counters['missed']}   "
+            f"ADC {mean('adc_elapsed_us', 1e-3)} ms   parse {mean('parse_latency_us')} µs   "
+            f"queue {mean('queue_depth')}   frame interval {mean('frame_interval_ms')} ms")
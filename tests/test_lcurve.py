@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from data_processing import helpers
+from data_processing.helpers import TikhonovSystem, curve_systems, get_contributions_path, find_Lcurve_corner, nnls_gram
+from data_processing.synthetic_signal import decay_rates
+
+ALPHAS = (5 ** np.arange(-6, 2, 0.1)) ** 2
+
+def g1_curves(seed=0):
+
+    rng  = np.random.default_rng(seed)
+    time = np.logspace(-5.5, -1.5, 120)
+    g1   = np.exp(-decay_rates([200])[0] * time)[:, None] + 0.003 * rng.standard_normal((len(time), 2))
+
+    return g1, time, np.logspace(np.log10(0.09), 6, 200)
+
+def test_failed_alphas_are_left_out_of_the_corner(monkeypatch):
+
+    g1, time, s_space = g1_curves()
+    residuals, penalties = get_contributions_path(g1, time, s_space, ALPHAS)
+    corner = find_Lcurve_corner(residuals[:, 0], penalties[:, 0])
+
+    solve = TikhonovSystem.solve
+    def failing_solve(self, alpha, data):
+        if alpha in (ALPHAS[3], ALPHAS[corner]):
+            raise np.linalg.LinAlgError("failed")
+        return solve(self, alpha, data)
+    monkeypatch.setattr(TikhonovSystem, "solve", failing_solve)
+
+    residuals, penalties = get_contributions_path(g1, time, s_space, ALPHAS)
+    assert np.all(np.isnan(residuals[[3, corner]])) and np.all(np.isnan(penalties[[3, corner]]))
+    assert np.isfinite(residuals).sum() == residuals.size - 4
+
+    failedCorner = find_Lcurve_corner(residuals[:, 0], penalties[:, 0])
+    assert failedCorner is not None and failedCorner not in (3, corner)
+    assert abs(failedCorner - corner) <= 2
+
+def test_unconverged_warm_solves_are_left_out(monkeypatch):
+
+    g1, time, s_space = g1_curves()
+    system = curve_systems(g1, time, s_space)[0][0]
+    system.solve_path(ALPHAS[:1], g1[:, 0]) # Builds the gram and penalty matrices
+
+    with pytest.raises(RuntimeError):
+        nnls_gram(system.gram, system.fidelity.T.dot(system.weighted(g1[:, 0])), maxiter=1)
+
+    calls = []
+    def nnls_gram_failing_once(G, h, x0=None, maxiter=None):
+        calls.append(x0)
+        return nnls_gram(G, h, x0, 1 if len(calls) == 11 else maxiter)
+    monkeypatch.setattr(helpers, "nnls_gram", nnls_gram_failing_once)
+
+    _, residuals, penalties = system.solve_path(ALPHAS, g1[:, 0])
+    assert np.isnan(residuals[10]) and np.isnan(penalties[10])
+    assert np.isfinite(np.delete(residuals, 10)).all()
+    assert calls[11] is None # The alpha after the failed one starts cold
+
+def test_kernel_svd_is_computed_once_per_curve_length(monkeypatch):
+
+    g1, time, s_space = g1_curves()
+    g1[100:, 1] = np.nan
+
+    calls = []
+    kernel_svd = helpers.kernel_svd
+    monkeypatch.setattr(helpers, "kernel_svd", lambda fidelity: calls.append(len(fidelity)) or kernel_svd(fidelity))
+
+    svds = {}
+    get_contributions_path(g1, time, s_space, ALPHAS, method="svd", warmStart=True, svds=svds)
+    assert calls == [] # The warm-started sweep works on the Gram matrix
+
+    for alpha in (0.1, 0.5):
+        helpers.get_contributios_prior(g1, time, s_space, None, alpha, method="svd", svds=svds)
+    assert sorted(calls) == [100 + 3, 120 + 3] and sorted(svds) == [100, 120]
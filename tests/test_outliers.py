@@ -0,0 +1,53 @@
+import numpy as np
+
+from data_processing.correlator import multi_tau_correlate
+from data_processing.helpers import outlier_curves, spike_segments
+from data_processing.synthetic_signal import synthetic_batches
+
+def dusty_run(seed, n_batches=2500, dust=slice(1000, 1500)):
+
+    readings, elapsed, _ = synthetic_batches(n_batches, [200], [1.0], seed=seed)
+    readings = readings.astype(float)
+    # Slow dust: a bump of 60 counts across every batch of one fifth of the run
+    readings[dust] += 60 * np.sin(np.pi * np.arange(readings.shape[1]) / readings.shape[1])
+
+    return multi_tau_correlate(readings, elapsed[0] / readings.shape[1] / 1e6, n_curves=5)
+
+def test_slow_dust_curve_is_flagged():
+
+    for seed in range(3):
+        time, g2 = dusty_run(seed)
+        beta, baseline = outlier_curves(g2, time)
+        assert list(beta | baseline) == [False, False, True, False, False]
+
+def test_clean_curves_are_kept():
+
+    for diameter in (50, 1000):
+        readings, elapsed, _ = synthetic_batches(2500, [diameter], [1.0], seed=0)
+        time, g2 = multi_tau_correlate(readings, elapsed[0] / readings.shape[1] / 1e6, n_curves=5)
+        beta, baseline = outlier_curves(g2, time)
+        assert not np.any(beta | baseline)
+
+def test_rising_baseline_is_flagged_for_two_curves():
+
+    rng  = np.random.default_rng(0)
+    time = np.logspace(-5.5, -1.8, 150)
+    g2   = 1 + 0.5 * np.exp(-2 * time / 3e-4)[:, None] + 0.002 * rng.standard_normal((len(time), 2))
+    # Slow contribution coming back at long lags: the baseline rises again after the decay
+    g2[:, 1] += 0.2 * np.clip(np.log(time / 2e-3) / np.log(time[-1] / 2e-3), 0, None)
+
+    beta, baseline = outlier_curves(g2, time)
+    assert list(baseline) == [False, True]
+    assert not np.any(beta)
+
+def test_spikes_are_flagged_in_their_segments_only():
+
+    for diameter in (1000, 3000):
+        readings, _, _ = synthetic_batches(5000, [diameter], [1.0], seed=0)
+        assert not np.any(spike_segments(readings))
+
+        readings = readings.astype(float)
+        # A short burst of stray light in a few segments, a slow dust bump in others
+        readings[[10, 2000, 4000], 400:402] = 1023
+        readings[2500:3000] += 60 * np.sin(np.pi * np.arange(readings.shape[1]) / readings.shape[1])
+        assert list(np.flatnonzero(spike_segments(readings))) == [10, 2000, 4000]
@@ -0,0 +1,88 @@
+import threading
+
+import numpy as np
+
+from connect_arduino import SerialRingReader, AcquisitionPipeline, decode_frame, FRAME_SIZE, LID_OPEN, SUBSET_LENGTH
+from fake_arduino import encode_frame
+
+ELAPSED = 3200
+
+class FakeSerial:
+
+    """
+    Serves the given chunks, one per read, then times out (reads nothing)
+    """
+
+    def __init__(self, chunks, on_empty=None):
+        self.chunks   = [bytes(chunk) for chunk in chunks]
+        self.on_empty = on_empty
+
+    @property
+    def in_waiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def readinto(self, view):
+        if not self.chunks:
+            if self.on_empty is not None:
+                self.on_empty()
+            return 0
+        chunk = self.chunks.pop(0)
+        view[:len(chunk)] = chunk[:len(view)]
+        if len(chunk) > len(view):
+            self.chunks.insert(0, chunk[len(view):])
+        return min(len(chunk), len(view))
+
+def frame(seq):
+
+    return encode_frame(seq, np.full(SUBSET_LENGTH, seq % 1024), ELAPSED, 21.5)
+
+def read_all(reader):
+
+    frames = []
+    while (frame := reader.read_frame()) is not None:
+        frames.append(decode_frame(frame))
+
+    return frames
+
+def test_frame_split_across_reads():
+
+    data   = frame(1) + frame(2)
+    reader = SerialRingReader(FakeSerial([data[:5], data[5:FRAME_SIZE + 3], data[FRAME_SIZE + 3:]]))
+
+    frames = read_all(reader)
+    assert [seq for *_, seq in frames] == [1, 2]
+    assert np.all(frames[1][0] == 2) and frames[1][1] == ELAPSED and frames[1][2] == 21.5
+    assert reader.bad_frames == 0 and not reader.lid_open
+
+def test_bad_crc_resyncs_on_the_next_frame():
+
+    corrupted = bytearray(frame(1))
+    corrupted[100] ^= 0xFF
+    assert decode_frame(bytes(corrupted)) is None
+
+    reader = SerialRingReader(FakeSerial([b'\x00\x07' + corrupted + frame(2)]))
+    assert [seq for *_, seq in read_all(reader)] == [2]
+    assert reader.bad_frames == 1
+
+def test_lid_open_between_frames():
+
+    reader = SerialRingReader(FakeSerial([frame(1) + LID_OPEN + frame(2)]))
+
+    assert decode_frame(reader.read_frame())[3] == 1 and not reader.lid_open
+    assert decode_frame(reader.read_frame())[3] == 2 and reader.lid_open
+
+def test_sequence_gaps_are_counted():
+
+    seqs       = [0xFFFD, 0xFFFE, 1, 2, 5]
+    stop_event = threading.Event()
+    reader     = SerialRingReader(FakeSerial([frame(seq) for seq in seqs], on_empty=stop_event.set))
+
+    batches  = []
+    pipeline = AcquisitionPipeline(reader, lambda *batch: batches.append(batch), binary=True)
+    pipeline.run(10, stop_event)
+
+    counters = pipeline.counters()
+    assert counters['read'] == counters['written'] == len(seqs)
+    assert counters['missed'] == 2 + 2 # 0xFFFF and 0 (across the wrap), then 3 and 4
+    # The time axis skips over the missing batches
+    assert [start for start, *_ in batches] == [ELAPSED * i for i in (0, 1, 4, 5, 8)]
@@ -0,0 +1,50 @@
+import numpy as np
+
+from data_processing.correlator import StreamingCorrelator, multi_tau_correlate
+from data_processing.csv_conversion import StreamingPeaks, peak_matrix
+from data_processing.helpers import spike_segments
+from data_processing.synthetic_signal import synthetic_batches
+
+def spiky_run(n_batches=200):
+
+    readings, elapsed, _ = synthetic_batches(n_batches, [1000], [1.0], seed=0)
+    readings = readings.astype(np.int64)
+    # Short bursts of stray light, one of them covering a whole block of StreamingCorrelator
+    readings[[5, 70, 150], 400:402] = 1023
+    readings[32:48, 600:602] = 1023
+
+    return readings, elapsed[0] / readings.shape[1]
+
+def stream(stream_type, readings, step):
+
+    stream = stream_type(readings.shape[1])
+    for row in readings:
+        stream.add_batch(0, step, 0, row)
+
+    return stream
+
+def test_streamed_g2_leaves_out_the_spikes():
+
+    readings, step = spiky_run()
+    keep = ~spike_segments(readings)
+    assert not keep[[5, 70, 150]].any() and np.count_nonzero(~keep[32:48]) >= 15
+
+    streamed = stream(StreamingCorrelator, readings, step)
+    time, g2 = streamed.snapshot(1)
+    expected_time, expected = multi_tau_correlate(readings, step / 1e6, keep=keep)
+
+    assert streamed.rejected == np.count_nonzero(~keep) and streamed.nBatches == len(readings)
+    assert np.allclose(time, expected_time) and np.allclose(g2, expected)
+    assert streamed.snapshot(20)[1].shape[1] == 13 # One curve per block with a kept batch
+
+def test_streamed_peaks_leave_out_the_spikes():
+
+    readings, step = spiky_run()
+    keep = ~spike_segments(readings)
+
+    streamed = stream(StreamingPeaks, readings, step)
+    time, curves = streamed.snapshot()
+    expected_time, expected = peak_matrix(readings, step, keep=keep)
+
+    assert streamed.rejected == np.count_nonzero(~keep)
+    assert np.allclose(time, expected_time) and np.allclose(curves, expected)
@@ -1,12 +1,19 @@
 // dls readings
 const unsigned int numReadings = 800;
-unsigned int analogVals[numReadings];
-long t, t0;
+uint16_t analogVals[numReadings];
+uint32_t t, t0;
 
 // switch + laser
 const int transistor = 7;
 char laser_on;
 
+// binary frames: sync (0xA5 0x5A), uint16 seq, numReadings x uint16, uint32 elapsed micros, int16 temperature (C x 100),
+// uint16 crc, all little-endian: the layout of FRAME_DTYPE in connect_arduino.py whatever the board's int size
+// 'B' switches to binary frames, 'T' back to comma separated text
+const byte frameSync[2] = {0xA5, 0x5A};
+bool binaryFrames = false;
+uint16_t frameSeq = 0;
+
 
 // Speed of the ADC, defines for setting and clearing register bits
 #ifndef cbi
@@ -17,6 +24,35 @@ char laser_on;
 #endif
 
 
+// CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF), matches binascii.crc_hqx on the host
+uint16_t crc16(uint16_t crc, const byte *data, size_t len) {
+  for (size_t i = 0; i < len; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (byte b = 0; b < 8; b++) {
+      crc = (crc & 0x8000) ? (uint16_t)((crc << 1) ^ 0x1021) : (uint16_t)(crc << 1);
+    }
+  }
+  return (uint16_t)crc;
+}
+
+void sendFrame(uint32_t elapsed, int16_t tempCenti) {
+  uint16_t crc = 0xFFFF;
+  crc = crc16(crc, (const byte *)&frameSeq, sizeof(frameSeq));
+  crc = crc16(crc, (const byte *)analogVals, sizeof(analogVals));
+  crc = crc16(crc, (const byte *)&elapsed, sizeof(elapsed));
+  crc = crc16(crc, (const byte *)&tempCenti, sizeof(tempCenti));
+
+  Serial.write(frameSync, sizeof(frameSync));
+  Serial.write((const byte *)&frameSeq, sizeof(frameSeq));
+  Serial.write((const byte *)analogVals, sizeof(analogVals));
+  Serial.write((const byte *)&elapsed, sizeof(elapsed));
+  Serial.write((const byte *)&tempCenti, sizeof(tempCenti));
+  Serial.write((const byte *)&crc, sizeof(crc));
+
+  frameSeq++;
+}
+
+
 void setup() {
   Serial.begin(115200);
 
@@ -50,18 +86,32 @@ void loop() {
     t = micros()-t0;  // calculate elapsed time
 
     if (Serial.available() > 0) {  // Check if data is available to read
-        laser_on = Serial.read();  // Read the incoming byte
+        char command = Serial.read();  // Read the incoming byte
+        if (command == 'B') {
+          binaryFrames = true;
+        }
+        else if (command == 'T') {
+          binaryFrames = false;
+        }
+        else {
+          laser_on = command;
+        }
     }
 
     // Send to computer
-    for (int i=0; i < numReadings ; i++)
-    {
-      Serial.print(analogVals[i]);
+    if (binaryFrames) {
+      sendFrame(t, 25 * 100);
+    }
+    else {
+      for (int i=0; i < numReadings ; i++)
+      {
+        Serial.print(analogVals[i]);
+        Serial.print(',');
+      }
+      Serial.print(t);
       Serial.print(',');
+      Serial.println(25);
     }
-    Serial.print(t);
-    Serial.print(',');
-    Serial.println(25);
   }
   else{
     digitalWrite(transistor, LOW);